@@ -1,6 +1,12 @@
 import os
+import sys
+import json
+import shutil
 import sqlite3
-from flask import Flask, render_template, request, redirect, flash, url_for
+import time
+import logging
+import threading
+from flask import Flask, render_template, stream_template, request, redirect, flash, url_for
 from flask import jsonify
 
 
@@ -8,6 +14,15 @@ from flask import jsonify
 app = Flask(__name__)
 app.secret_key = 'chave_secreta'
 
+# Logs da aplicação (nível configurável pela variável de ambiente LOG_LEVEL)
+logger = logging.getLogger('produtos')
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(_handler)
+logger.setLevel(app.config['LOG_LEVEL'])
+
 # Configuração do caminho absoluto para o banco de dados
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Diretório do arquivo app.py
 DB_NAME = os.path.join(BASE_DIR, 'database/products_system.db')  # Caminho absoluto para o banco
@@ -23,166 +38,1528 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
-# Inicialização do banco de dados (exemplo)
-def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        # Criar a tabela 'products' com todas as colunas necessárias
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codigo TEXT,
-                ean TEXT,
-                descricao TEXT,
-                categoria TEXT,
-                marca TEXT,
-                modelo TEXT,
-                cor TEXT,
-                faixa_etaria TEXT,
-                genero TEXT,
-                nome_comercial TEXT
-            )
-        ''')
+# Configuração das conexões SQLite (reutilizadas por thread)
+app.config['DATABASE'] = DB_NAME
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL'      # Leitores não bloqueiam durante escritas
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'    # Seguro com WAL e bem mais rápido que FULL
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['SQLITE_CACHE_SIZE'] = -64000       # Negativo = tamanho em KB (~64 MB)
+app.config['SQLITE_BUSY_TIMEOUT'] = 5000       # ms aguardando um lock antes de falhar
+app.config['SQLITE_STATEMENT_CACHE'] = 256     # Comandos preparados mantidos por conexão
 
-        # Verificar colunas existentes e adicionar as faltantes
-        cursor.execute("PRAGMA table_info(products)")
-        existing_columns = [column[1] for column in cursor.fetchall()]
+_conexoes = threading.local()
 
-        required_columns = ["categoria", "marca", "modelo", "cor", "faixa_etaria", "genero", "nome_comercial"]
-        for column in required_columns:
-            if column not in existing_columns:
-                cursor.execute(f"ALTER TABLE products ADD COLUMN {column} TEXT")
-                print(f"Coluna '{column}' adicionada ao banco de dados.")
 
-        conn.commit()
-        print("Banco de dados atualizado com sucesso!")
+def abrir_conexao(caminho=None):
+    """
+    Abre uma nova conexão SQLite já configurada com os PRAGMAs de app.config.
+    """
+    instrumentar = app.config['INSTRUMENTACAO_SQL']
+    conn = sqlite3.connect(
+        caminho or app.config['DATABASE'],
+        timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000,
+        cached_statements=app.config['SQLITE_STATEMENT_CACHE'],
+        factory=ConexaoInstrumentada if instrumentar else sqlite3.Connection
+    )
+    if instrumentar:
+        conn.set_trace_callback(contar_comando_sql)
+    conn.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def get_db():
+    """
+    Retorna a conexão da thread atual, criando-a na primeira chamada.
+    Use com `with get_db() as conn:` para commit/rollback automáticos; a
+    conexão continua aberta para as próximas requisições da mesma thread.
+    """
+    chave = (os.getpid(), app.config['DATABASE'])
+    pool = getattr(_conexoes, 'pool', None)
+    if pool is None:
+        pool = _conexoes.pool = {}
 
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS product_custom_field_values (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                produto_id INTEGER NOT NULL,
-                campo_id INTEGER NOT NULL,
-                valor_id INTEGER NOT NULL,
-                UNIQUE(produto_id, campo_id)
-            )
+    conn = pool.get(chave)
+    if conn is None:
+        conn = pool[chave] = abrir_conexao(chave[1])
+    return conn
+
+
+def fechar_conexoes():
+    """
+    Fecha as conexões abertas pela thread atual.
+    """
+    for conn in getattr(_conexoes, 'pool', {}).values():
+        conn.close()
+    _conexoes.pool = {}
+
+
+@app.teardown_appcontext
+def liberar_conexao(exception):
+    # Garante que nenhuma transação fique aberta entre requisições
+    for conn in getattr(_conexoes, 'pool', {}).values():
+        if conn.in_transaction:
+            conn.rollback()
+
+
+# Instrumentação: latência por rota, SQL por requisição e log de consultas lentas
+app.config['INSTRUMENTACAO_SQL'] = True
+app.config['SLOW_QUERY_MS'] = 200
+app.config['METRICAS_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metricas_lock = threading.Lock()
+_metricas = {
+    'latencia': {},        # (endpoint, metodo) -> {'buckets': [...], 'soma': s, 'total': n}
+    'requisicoes': {},     # (endpoint, metodo, status) -> n
+    'sql_comandos': {},    # endpoint -> comandos executados (inclui os de triggers)
+    'sql_segundos': {},    # endpoint -> tempo total em execute/executemany
+    'sql_lentas': 0,
+}
+_requisicao_atual = threading.local()
+
+
+def contar_comando_sql(sql):
+    # Trace callback do SQLite: chamado a cada comando executado
+    estado = getattr(_requisicao_atual, 'estado', None)
+    if estado is not None:
+        estado['comandos'] += 1
+
+
+def somar_tempo_sql(duracao):
+    estado = getattr(_requisicao_atual, 'estado', None)
+    if estado is not None:
+        estado['sql_segundos'] += duracao
+    return estado
+
+
+def registrar_consulta(sql, duracao):
+    estado = somar_tempo_sql(duracao)
+
+    if duracao * 1000 >= app.config['SLOW_QUERY_MS']:
+        with _metricas_lock:
+            _metricas['sql_lentas'] += 1
+        endpoint = estado['endpoint'] if estado is not None else '-'
+        logger.warning("Consulta lenta (%.1f ms) em %s: %s", duracao * 1000, endpoint, ' '.join(sql.split())[:500])
+
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """
+    Cursor que mede o tempo de execute/executemany e das leituras por
+    fetchone/fetchmany/fetchall (onde o SQLite avança a consulta). A
+    iteração direta sobre o cursor não é medida, para não pesar por linha.
+    """
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            registrar_consulta(sql, time.perf_counter() - inicio)
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            registrar_consulta(sql, time.perf_counter() - inicio)
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            somar_tempo_sql(time.perf_counter() - inicio)
+
+    def fetchmany(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            somar_tempo_sql(time.perf_counter() - inicio)
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            somar_tempo_sql(time.perf_counter() - inicio)
+
+
+class ConexaoInstrumentada(sqlite3.Connection):
+    """
+    Conexão cujos cursores são instrumentados. O execute/executemany da
+    própria conexão (implementado em C) não passaria pelo cursor(), por isso
+    é redefinido aqui sobre um CursorInstrumentado.
+    """
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+
+@app.before_request
+def iniciar_medicao():
+    _requisicao_atual.estado = {
+        'inicio': time.perf_counter(),
+        'endpoint': request.endpoint or 'desconhecido',
+        'comandos': 0,
+        'sql_segundos': 0.0,
+    }
+
+
+def finalizar_medicao(estado, metodo, caminho, status):
+    """
+    Registra as métricas da requisição. Roda quando a resposta é fechada,
+    para incluir o que as respostas em streaming (/produtos, /exportar)
+    executam depois do after_request (e do teardown da requisição).
+    """
+    if getattr(_requisicao_atual, 'estado', None) is estado:
+        _requisicao_atual.estado = None
+    duracao = time.perf_counter() - estado['inicio']
+    endpoint = estado['endpoint']
+    buckets = app.config['METRICAS_BUCKETS']
+    with _metricas_lock:
+        histograma = _metricas['latencia'].setdefault(
+            (endpoint, metodo), {'buckets': [0] * len(buckets), 'soma': 0.0, 'total': 0}
+        )
+        for indice, limite in enumerate(buckets):
+            if duracao <= limite:
+                histograma['buckets'][indice] += 1
+        histograma['soma'] += duracao
+        histograma['total'] += 1
+
+        chave = (endpoint, metodo, status)
+        _metricas['requisicoes'][chave] = _metricas['requisicoes'].get(chave, 0) + 1
+        _metricas['sql_comandos'][endpoint] = _metricas['sql_comandos'].get(endpoint, 0) + estado['comandos']
+        _metricas['sql_segundos'][endpoint] = _metricas['sql_segundos'].get(endpoint, 0.0) + estado['sql_segundos']
+
+    logger.debug("%s %s -> %s em %.1f ms (%s comandos SQL, %.1f ms em SQL)",
+                 metodo, caminho, status, duracao * 1000,
+                 estado['comandos'], estado['sql_segundos'] * 1000)
+
+
+@app.after_request
+def registrar_medicao(response):
+    estado = getattr(_requisicao_atual, 'estado', None)
+    if estado is not None:
+        metodo, caminho, status = request.method, request.path, response.status_code
+        response.call_on_close(lambda: finalizar_medicao(estado, metodo, caminho, status))
+    return response
+
+
+def _rotulos(**rotulos):
+    texto = ','.join(
+        '{}="{}"'.format(nome, str(valor).replace('\\', '\\\\').replace('"', '\\"'))
+        for nome, valor in rotulos.items()
+    )
+    return '{' + texto + '}'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Métricas no formato texto do Prometheus.
+    """
+    buckets = app.config['METRICAS_BUCKETS']
+    linhas = []
+    with _metricas_lock:
+        linhas.append('# HELP http_request_duration_seconds Latência das requisições por rota.')
+        linhas.append('# TYPE http_request_duration_seconds histogram')
+        for (endpoint, metodo), histograma in sorted(_metricas['latencia'].items()):
+            for limite, quantidade in zip(buckets, histograma['buckets']):
+                linhas.append(f"http_request_duration_seconds_bucket{_rotulos(endpoint=endpoint, method=metodo, le=limite)} {quantidade}")
+            linhas.append(f"http_request_duration_seconds_bucket{_rotulos(endpoint=endpoint, method=metodo, le='+Inf')} {histograma['total']}")
+            linhas.append(f"http_request_duration_seconds_sum{_rotulos(endpoint=endpoint, method=metodo)} {histograma['soma']}")
+            linhas.append(f"http_request_duration_seconds_count{_rotulos(endpoint=endpoint, method=metodo)} {histograma['total']}")
+
+        linhas.append('# HELP http_requests_total Requisições por rota, método e status.')
+        linhas.append('# TYPE http_requests_total counter')
+        for (endpoint, metodo, status), total in sorted(_metricas['requisicoes'].items()):
+            linhas.append(f"http_requests_total{_rotulos(endpoint=endpoint, method=metodo, status=status)} {total}")
+
+        linhas.append('# HELP sql_statements_total Comandos SQL executados (inclui triggers) por rota.')
+        linhas.append('# TYPE sql_statements_total counter')
+        for endpoint, total in sorted(_metricas['sql_comandos'].items()):
+            linhas.append(f"sql_statements_total{_rotulos(endpoint=endpoint)} {total}")
+
+        linhas.append('# HELP sql_duration_seconds_total Tempo gasto em SQL por rota.')
+        linhas.append('# TYPE sql_duration_seconds_total counter')
+        for endpoint, total in sorted(_metricas['sql_segundos'].items()):
+            linhas.append(f"sql_duration_seconds_total{_rotulos(endpoint=endpoint)} {total}")
+
+        linhas.append('# HELP sql_slow_queries_total Consultas acima de SLOW_QUERY_MS.')
+        linhas.append('# TYPE sql_slow_queries_total counter')
+        linhas.append(f"sql_slow_queries_total {_metricas['sql_lentas']}")
+
+    cache = estatisticas_cache_campos()
+    for nome in ('hits', 'misses', 'evictions'):
+        linhas.append(f'# TYPE cache_campos_{nome}_total counter')
+        linhas.append(f"cache_campos_{nome}_total {cache[nome]}")
+
+    return ('\n'.join(linhas) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# Colunas de products e seus tipos (definição única do esquema)
+COLUNAS_PRODUCTS = (
+    ('codigo', 'TEXT'),
+    ('ean', 'TEXT'),
+    ('descricao', 'TEXT'),
+    ('ncm', 'TEXT'),
+    ('cfop', 'TEXT'),
+    ('quantidade', 'REAL'),
+    ('preco_unitario', 'REAL'),
+    ('preco_total', 'REAL'),
+    ('icms_base', 'REAL'),
+    ('icms_percentual', 'REAL'),
+    ('icms_valor', 'REAL'),
+    ('ipi_base', 'REAL'),
+    ('ipi_percentual', 'REAL'),
+    ('ipi_valor', 'REAL'),
+    ('categoria', 'TEXT'),
+    ('marca', 'TEXT'),
+    ('modelo', 'TEXT'),
+    ('cor', 'TEXT'),
+    ('faixa_etaria', 'TEXT'),
+    ('genero', 'TEXT'),
+    ('nome_comercial', 'TEXT'),
+)
+
+
+def migracao_esquema_base(cursor):
+    """
+    Cria as tabelas principais e completa as colunas que faltarem em bancos
+    criados por versões anteriores.
+    """
+    colunas = ',\n'.join(f"{nome} {tipo}" for nome, tipo in COLUNAS_PRODUCTS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {colunas}
+        )
+    ''')
+
+    cursor.execute("PRAGMA table_info(products)")
+    existing_columns = [column[1] for column in cursor.fetchall()]
+    for nome, tipo in COLUNAS_PRODUCTS:
+        if nome not in existing_columns:
+            cursor.execute(f"ALTER TABLE products ADD COLUMN {nome} {tipo}")
+            logger.info("Coluna '%s' adicionada ao banco de dados.", nome)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS custom_fields (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            tipo TEXT NOT NULL DEFAULT 'manual'
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(custom_fields)")
+    if 'tipo' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE custom_fields ADD COLUMN tipo TEXT DEFAULT 'manual'")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS custom_values (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campo_id INTEGER NOT NULL,
+            valor TEXT NOT NULL,
+            FOREIGN KEY (campo_id) REFERENCES custom_fields(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_custom_field_values (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            produto_id INTEGER NOT NULL,
+            campo_id INTEGER NOT NULL,
+            valor_id INTEGER NOT NULL,
+            UNIQUE(produto_id, campo_id),
+            FOREIGN KEY (produto_id) REFERENCES products(id),
+            FOREIGN KEY (campo_id) REFERENCES custom_fields(id),
+            FOREIGN KEY (valor_id) REFERENCES custom_values(id)
+        )
+    ''')
+
+    # Hash de cada XML já importado
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS imported_files (
+            hash TEXT PRIMARY KEY,
+            arquivo TEXT,
+            itens INTEGER,
+            importado_em TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def migracao_upsert_produtos(cursor):
+    """
+    Índice único usado pelo upsert de produtos na importação.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_products_codigo_ean'")
+    if not cursor.fetchone():
+        removidos = deduplicar_produtos(cursor)
+        cursor.execute("CREATE UNIQUE INDEX idx_products_codigo_ean ON products(codigo, ean)")
+        logger.info("Índice único (codigo, ean) criado. Duplicados removidos: %s", removidos)
+
+
+def migracao_nome_pendente(cursor):
+    """
+    Marca de produtos com nome comercial desatualizado (modo incremental).
+    """
+    cursor.execute("PRAGMA table_info(products)")
+    if "nome_comercial_pendente" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE products ADD COLUMN nome_comercial_pendente INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_products_nome_pendente
+        ON products(id) WHERE nome_comercial_pendente = 1
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_nome_pendente_au
+        AFTER UPDATE OF categoria, marca, modelo, cor, faixa_etaria, genero ON products
+        BEGIN
+            UPDATE products SET nome_comercial_pendente = 1 WHERE id = new.id;
+        END
+    """)
+
+
+def migracao_indices(cursor):
+    """
+    Índices das buscas por campo/valor personalizado e dos filtros da listagem.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_custom_values_campo ON custom_values(campo_id)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pcfv_campo_valor
+        ON product_custom_field_values(campo_id, valor_id)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcfv_valor ON product_custom_field_values(valor_id)")
+    for coluna in ('categoria', 'marca', 'modelo', 'cor', 'genero'):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_products_{coluna} ON products({coluna})")
+
+
+def migracao_busca(cursor):
+    """
+    Índice de busca textual (FTS5) mantido por triggers.
+    """
+    try:
+        criar_indice_busca(cursor)
+    except sqlite3.OperationalError as e:
+        logger.warning("Busca textual indisponível (FTS5): %s", e)
+
+
+def migracao_jobs(cursor):
+    """
+    Tabela da fila de jobs em segundo plano.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            parametros TEXT,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            processados INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            resultado TEXT,
+            erro TEXT,
+            cancelar INTEGER NOT NULL DEFAULT 0,
+            criado_em TEXT DEFAULT CURRENT_TIMESTAMP,
+            iniciado_em REAL,
+            finalizado_em REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+
+
+# Colunas de products editáveis na grade de /produtos
+CAMPOS_EDITAVEIS = ('descricao', 'categoria', 'marca', 'modelo', 'cor',
+                    'faixa_etaria', 'genero', 'nome_comercial')
+
+
+def migracao_versao_produtos(cursor):
+    """
+    Versão da linha para a concorrência otimista da grade de produtos.
+    Quem altera colunas editáveis sem incrementar a versão (ex.: UPDATE
+    manual) tem a versão incrementada pelo trigger.
+    """
+    cursor.execute("ALTER TABLE products ADD COLUMN versao INTEGER NOT NULL DEFAULT 1")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_versao_au
+        AFTER UPDATE OF {', '.join(CAMPOS_EDITAVEIS)} ON products
+        WHEN new.versao = old.versao
+        BEGIN
+            UPDATE products SET versao = old.versao + 1 WHERE id = new.id;
+        END
+    """)
+
+
+# Colunas de products com contagem pré-calculada (facetas)
+COLUNAS_FACETAS = ('categoria', 'marca', 'cor', 'faixa_etaria', 'genero')
+
+
+def sql_somar_faceta(coluna, valor, delta):
+    """
+    Comando de trigger que soma `delta` à faceta (coluna, valor), criando-a
+    se necessário. Valores nulos não entram nas facetas.
+    """
+    return f"""
+        INSERT INTO facetas_produtos (coluna, valor, total)
+        SELECT '{coluna}', {valor}, {delta} WHERE {valor} IS NOT NULL
+        ON CONFLICT (coluna, valor) DO UPDATE SET total = total + {delta};"""
+
+
+def sql_somar_faceta_valor(campo_id, valor_id, delta):
+    return f"""
+        INSERT INTO facetas_valores (campo_id, valor_id, total)
+        VALUES ({campo_id}, {valor_id}, {delta})
+        ON CONFLICT (campo_id, valor_id) DO UPDATE SET total = total + {delta};"""
+
+
+def reconstruir_facetas(cursor):
+    """
+    Recalcula as tabelas de facetas a partir de products e
+    product_custom_field_values (carga inicial ou correção).
+    """
+    cursor.execute("DELETE FROM facetas_produtos")
+    for coluna in COLUNAS_FACETAS:
+        cursor.execute(f"""
+            INSERT INTO facetas_produtos (coluna, valor, total)
+            SELECT '{coluna}', {coluna}, COUNT(*)
+            FROM products
+            WHERE {coluna} IS NOT NULL
+            GROUP BY {coluna}
         """)
-        conn.commit()
+    cursor.execute("DELETE FROM facetas_valores")
+    cursor.execute("""
+        INSERT INTO facetas_valores (campo_id, valor_id, total)
+        SELECT campo_id, valor_id, COUNT(*)
+        FROM product_custom_field_values
+        GROUP BY campo_id, valor_id
+    """)
 
-        cursor.execute('''
-    CREATE TABLE IF NOT EXISTS custom_fields (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nome TEXT NOT NULL,
-        tipo TEXT NOT NULL DEFAULT 'manual'
-            )
-        ''')
-        print("tabbela manual criada e acessada.")
-
-        # Criar tabela 'custom_fields'
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS custom_fields (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL
-            )
-        ''')
-        print("Tabela 'custom_fields' criada/verificada.")
-
-        # Criar tabela 'custom_values'
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS custom_values (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                campo_id INTEGER NOT NULL,
-                valor TEXT NOT NULL,
-                FOREIGN KEY (campo_id) REFERENCES custom_fields(id)
-            )
-        ''')
-        print("Tabela 'custom_values' criada/verificada.")
-
-        # Criar tabela 'product_custom_field_values'
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS product_custom_field_values (
-                produto_id INTEGER NOT NULL,
-                campo_id INTEGER NOT NULL,
-                valor_id INTEGER NOT NULL,
-                PRIMARY KEY (produto_id, campo_id),
-                FOREIGN KEY (produto_id) REFERENCES products(id),
-                FOREIGN KEY (campo_id) REFERENCES custom_fields(id),
-                FOREIGN KEY (valor_id) REFERENCES custom_values(id)
-            )
-        ''')
-        print("Tabela 'product_custom_field_values' criada/verificada.")
 
-    print("Banco de dados inicializado com sucesso!")
+def migracao_facetas(cursor):
+    """
+    Contagens de produtos por valor de coluna e por valor personalizado,
+    mantidas pelos triggers a cada INSERT/UPDATE/DELETE (importação,
+    grade, atribuições), para /api/facetas não precisar de GROUP BY.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS facetas_produtos (
+            coluna TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (coluna, valor)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS facetas_valores (
+            campo_id INTEGER NOT NULL,
+            valor_id INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (campo_id, valor_id)
+        ) WITHOUT ROWID
+    """)
+
+    somar_novos = ''.join(sql_somar_faceta(coluna, f'new.{coluna}', 1) for coluna in COLUNAS_FACETAS)
+    subtrair_antigos = ''.join(sql_somar_faceta(coluna, f'old.{coluna}', -1) for coluna in COLUNAS_FACETAS)
+    gatilhos = [
+        f"CREATE TRIGGER IF NOT EXISTS products_facetas_ai AFTER INSERT ON products BEGIN {somar_novos} END",
+        f"CREATE TRIGGER IF NOT EXISTS products_facetas_ad AFTER DELETE ON products BEGIN {subtrair_antigos} END",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_facetas_ai AFTER INSERT ON product_custom_field_values BEGIN
+            {sql_somar_faceta_valor('new.campo_id', 'new.valor_id', 1)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_facetas_ad AFTER DELETE ON product_custom_field_values BEGIN
+            {sql_somar_faceta_valor('old.campo_id', 'old.valor_id', -1)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_facetas_au
+        AFTER UPDATE OF campo_id, valor_id ON product_custom_field_values
+        WHEN old.campo_id IS NOT new.campo_id OR old.valor_id IS NOT new.valor_id
+        BEGIN
+            {sql_somar_faceta_valor('old.campo_id', 'old.valor_id', -1)}
+            {sql_somar_faceta_valor('new.campo_id', 'new.valor_id', 1)}
+        END
+        """,
+    ]
+    # Um trigger de UPDATE por coluna, disparado só quando o valor muda
+    for coluna in COLUNAS_FACETAS:
+        gatilhos.append(f"""
+        CREATE TRIGGER IF NOT EXISTS products_facetas_{coluna}_au
+        AFTER UPDATE OF {coluna} ON products
+        WHEN old.{coluna} IS NOT new.{coluna}
+        BEGIN
+            {sql_somar_faceta(coluna, f'old.{coluna}', -1)}
+            {sql_somar_faceta(coluna, f'new.{coluna}', 1)}
+        END
+        """)
+    for gatilho in gatilhos:
+        cursor.execute(gatilho)
+
+    reconstruir_facetas(cursor)
+
 
-# Função para processar o arquivo XML
+def migracao_rejeitados(cursor):
+    """
+    Relatório dos itens de NF-e recusados na validação, por arquivo.
+    """
+    cursor.execute("ALTER TABLE imported_files ADD COLUMN rejeitados INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itens_rejeitados (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT NOT NULL,
+            arquivo TEXT,
+            item TEXT,
+            codigo TEXT,
+            descricao TEXT,
+            motivo TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_itens_rejeitados_hash ON itens_rejeitados(hash)")
+
+
+def migracao_ean_vazio(cursor):
+    """
+    EAN ausente passa a ser gravado como '' (o índice único trata NULLs
+    como distintos e o upsert nunca os encontraria). Remove as cópias já
+    criadas por reimportações antes de converter.
+    """
+    removidos = deduplicar_produtos(cursor)
+    cursor.execute("UPDATE products SET ean = '' WHERE ean IS NULL")
+    logger.info("EAN nulo convertido para vazio. Duplicados removidos: %s", removidos)
+
+
+def migracao_versao_campos(cursor):
+    """
+    Contador de versão de custom_fields/custom_values, incrementado por
+    triggers, usado pelo cache de campos para invalidar entre processos.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versao (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            versao INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO cache_versao (id, versao) VALUES (1, 0)")
+    for tabela in ('custom_fields', 'custom_values'):
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {tabela}_versao_{evento.lower()}
+                AFTER {evento} ON {tabela}
+                BEGIN
+                    UPDATE cache_versao SET versao = versao + 1 WHERE id = 1;
+                END
+            """)
+
+
+# Migrações aplicadas em ordem; a versão do banco fica em PRAGMA user_version.
+# Novas alterações de esquema devem ser acrescentadas ao final da lista.
+MIGRACOES = [
+    migracao_esquema_base,
+    migracao_upsert_produtos,
+    migracao_nome_pendente,
+    migracao_indices,
+    migracao_busca,
+    migracao_jobs,
+    migracao_versao_produtos,
+    migracao_facetas,
+    migracao_rejeitados,
+    migracao_ean_vazio,
+    migracao_versao_campos,
+]
+
+
+def init_db():
+    """
+    Aplica as migrações pendentes. Com o banco já atualizado, custa apenas
+    a leitura de PRAGMA user_version.
+    """
+    conn = get_db()
+    versao = conn.execute("PRAGMA user_version").fetchone()[0]
+    if versao >= len(MIGRACOES):
+        return
+
+    for numero, migracao in enumerate(MIGRACOES[versao:], start=versao + 1):
+        try:
+            conn.execute("BEGIN")
+            migracao(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception("Erro ao aplicar a migração %s (%s).", numero, migracao.__name__)
+            raise
+        logger.info("Migração %s aplicada: %s", numero, migracao.__name__)
+
+    logger.info("Banco de dados inicializado com sucesso!")
+
+
+def deduplicar_produtos(cursor):
+    """
+    Mantém apenas o produto mais antigo de cada (codigo, ean), movendo para
+    ele os valores personalizados das cópias antes de apagá-las. EAN nulo e
+    vazio contam como o mesmo EAN.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE duplicados AS
+        SELECT p.id AS id, k.manter AS manter
+        FROM products p
+        JOIN (
+            SELECT codigo, COALESCE(ean, '') AS ean, MIN(id) AS manter
+            FROM products
+            GROUP BY codigo, COALESCE(ean, '')
+            HAVING COUNT(*) > 1
+        ) k ON p.codigo = k.codigo AND COALESCE(p.ean, '') = k.ean
+        WHERE p.id <> k.manter
+    """)
+    cursor.execute("""
+        UPDATE OR IGNORE product_custom_field_values
+        SET produto_id = (SELECT manter FROM duplicados WHERE duplicados.id = produto_id)
+        WHERE produto_id IN (SELECT id FROM duplicados)
+    """)
+    cursor.execute("DELETE FROM product_custom_field_values WHERE produto_id IN (SELECT id FROM duplicados)")
+    cursor.execute("DELETE FROM products WHERE id IN (SELECT id FROM duplicados)")
+    removidos = cursor.rowcount
+    cursor.execute("DROP TABLE duplicados")
+    return removidos
+
+
+# Texto dos valores personalizados atribuídos a um produto, usado no índice de busca
+SQL_VALORES_BUSCA = """
+    (SELECT group_concat(cv.valor, ' ')
+     FROM product_custom_field_values pv
+     JOIN custom_values cv ON cv.id = pv.valor_id
+     WHERE pv.produto_id = {produto_id})
+"""
+
+
+def criar_indice_busca(cursor):
+    """
+    Cria a tabela FTS5 products_fts (rowid = products.id) e os triggers que
+    a mantêm sincronizada com products, product_custom_field_values e
+    custom_values. Na primeira execução o índice é populado por completo.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+    if cursor.fetchone():
+        return
+
+    cursor.execute("""
+        CREATE VIRTUAL TABLE products_fts USING fts5(
+            descricao, nome_comercial, marca, valores,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+
+    gatilhos = [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, descricao, nome_comercial, marca, valores)
+            VALUES (new.id, new.descricao, new.nome_comercial, new.marca,
+                    {SQL_VALORES_BUSCA.format(produto_id='new.id')});
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_au
+        AFTER UPDATE OF descricao, nome_comercial, marca ON products BEGIN
+            UPDATE products_fts
+            SET descricao = new.descricao, nome_comercial = new.nome_comercial, marca = new.marca
+            WHERE rowid = new.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_fts_ai AFTER INSERT ON product_custom_field_values BEGIN
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='new.produto_id')}
+            WHERE rowid = new.produto_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_fts_au AFTER UPDATE ON product_custom_field_values BEGIN
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='old.produto_id')}
+            WHERE rowid = old.produto_id;
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='new.produto_id')}
+            WHERE rowid = new.produto_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS pcfv_fts_ad AFTER DELETE ON product_custom_field_values BEGIN
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='old.produto_id')}
+            WHERE rowid = old.produto_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS custom_values_fts_au AFTER UPDATE OF valor ON custom_values BEGIN
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='products_fts.rowid')}
+            WHERE rowid IN (SELECT produto_id FROM product_custom_field_values WHERE valor_id = new.id);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS custom_values_fts_ad AFTER DELETE ON custom_values BEGIN
+            UPDATE products_fts SET valores = {SQL_VALORES_BUSCA.format(produto_id='products_fts.rowid')}
+            WHERE rowid IN (SELECT produto_id FROM product_custom_field_values WHERE valor_id = old.id);
+        END
+        """,
+    ]
+    for gatilho in gatilhos:
+        cursor.execute(gatilho)
+
+    cursor.execute(f"""
+        INSERT INTO products_fts (rowid, descricao, nome_comercial, marca, valores)
+        SELECT p.id, p.descricao, p.nome_comercial, p.marca, {SQL_VALORES_BUSCA.format(produto_id='p.id')}
+        FROM products p
+    """)
+    logger.info("Índice de busca 'products_fts' criado com %s produtos.", cursor.rowcount)
+
+# Leitura da NF-e em streaming e gravação dos itens em lotes
+import hashlib
+from array import array
+from collections import namedtuple
 import xml.etree.ElementTree as ET  # Certifique-se de que já importou este módulo
 
-def processar_xml(file_path):
-    print(f"Processando o arquivo XML: {file_path}")
+try:
+    import resource  # Disponível apenas em sistemas Unix
+except ImportError:
+    resource = None
+
+# Namespace da NF-e em notação Clark, usado para buscas diretas por filho
+NFE_NS = '{http://www.portalfiscal.inf.br/nfe}'
+
+# Quantidade de itens enviados ao banco em cada executemany
+app.config['IMPORT_BATCH_SIZE'] = 1000
+
+# Em nível DEBUG, registra 1 a cada N itens importados
+app.config['LOG_AMOSTRAGEM_ITENS'] = 1000
+
+# Colunas de products preenchidas a partir de cada item da NF-e
+CAMPOS_ITEM_NFE = ('codigo', 'ean', 'descricao', 'ncm', 'cfop', 'quantidade', 'preco_unitario',
+                   'preco_total', 'icms_base', 'icms_percentual', 'icms_valor',
+                   'ipi_base', 'ipi_percentual', 'ipi_valor')
+
+# Item lido do XML: uma tupla com nomes, bem menor que um dict por item
+ItemNfe = namedtuple('ItemNfe', CAMPOS_ITEM_NFE)
+
+# Campos de texto do item; os demais são numéricos (float)
+TOTAL_CAMPOS_TEXTO_NFE = 5
+
+# Na reimportação só os dados fiscais, quantidades e preços são atualizados;
+# a descrição pode ter sido editada na grade e é preservada. Como nenhum
+# campo editável muda, a versão da linha (concorrência da grade) também não
+CAMPOS_ATUALIZADOS_NFE = tuple(
+    campo for campo in CAMPOS_ITEM_NFE if campo not in ('codigo', 'ean', 'descricao')
+)
+
+SQL_INSERIR_PRODUTO = f'''
+    INSERT INTO products ({', '.join(CAMPOS_ITEM_NFE)})
+    VALUES ({', '.join('?' * len(CAMPOS_ITEM_NFE))})
+    ON CONFLICT (codigo, ean) DO UPDATE SET
+        {', '.join(f"{campo} = excluded.{campo}" for campo in CAMPOS_ATUALIZADOS_NFE)}
+'''
+
+
+def _texto(elemento, tag):
+    """
+    Retorna o texto do filho direto `tag` (sem namespace) ou None.
+    """
+    if elemento is None:
+        return None
+    filho = elemento.find(NFE_NS + tag)
+    return filho.text if filho is not None else None
+
+
+def _internar(texto):
+    return sys.intern(texto) if texto is not None else None
+
+
+def pico_memoria_mb():
+    """
+    Pico de memória residente (RSS) do processo em MB, quando disponível.
+    """
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KB, macOS em bytes
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(pico / divisor, 1)
+
+
+# Grupos de ICMS por tributação. Nos grupos obrigatórios vBC, pICMS e vICMS
+# precisam existir; nos opcionais entram quando informados; nos demais
+# (isentos, não tributados, ST cobrado antes, Simples Nacional sem crédito
+# destacado...) o ICMS próprio do item é zero.
+GRUPOS_ICMS_OBRIGATORIOS = {'ICMS00', 'ICMS10', 'ICMS20', 'ICMS70', 'ICMSPart'}
+GRUPOS_ICMS_OPCIONAIS = {'ICMS51', 'ICMS90', 'ICMSSN900'}
+CAMPOS_ICMS = ('vBC', 'pICMS', 'vICMS')
+
+
+class ItemNfeInvalido(ValueError):
+    pass
+
+
+def _decimal(elemento, tag, obrigatorio=True, padrao=0.0):
+    """
+    Valor numérico do filho `tag`. Ausente: ItemNfeInvalido se obrigatório,
+    senão `padrao`. Texto não numérico é sempre ItemNfeInvalido.
+    """
+    texto = _texto(elemento, tag)
+    if texto is None:
+        if obrigatorio:
+            raise ItemNfeInvalido(f"{tag} ausente")
+        return padrao
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        namespace = {'ns': 'http://www.portalfiscal.inf.br/nfe'}
+        return float(texto)
+    except ValueError:
+        raise ItemNfeInvalido(f"{tag} inválido: {texto!r}") from None
 
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
 
-            for det in root.findall('.//ns:det', namespace):
-                produto = {
-                    'codigo': det.find('.//ns:cProd', namespace).text,
-                    'ean': det.find('.//ns:cEAN', namespace).text,
-                    'descricao': det.find('.//ns:xProd', namespace).text,
-                    'ncm': det.find('.//ns:NCM', namespace).text,
-                    'cfop': det.find('.//ns:CFOP', namespace).text,
-                    'quantidade': float(det.find('.//ns:qCom', namespace).text),
-                    'preco_unitario': float(det.find('.//ns:vUnCom', namespace).text),
-                    'preco_total': float(det.find('.//ns:vProd', namespace).text),
-                    'icms_base': float(det.find('.//ns:vBC', namespace).text),
-                    'icms_percentual': float(det.find('.//ns:pICMS', namespace).text),
-                    'icms_valor': float(det.find('.//ns:vICMS', namespace).text),
-                    'ipi_base': float(det.find('.//ns:vBCIPI', namespace).text) if det.find('.//ns:vBCIPI', namespace) is not None else 0.0,
-                    'ipi_percentual': float(det.find('.//ns:pIPI', namespace).text) if det.find('.//ns:pIPI', namespace) is not None else 0.0,
-                    'ipi_valor': float(det.find('.//ns:vIPI', namespace).text) if det.find('.//ns:vIPI', namespace) is not None else 0.0
+def valores_icms(imposto):
+    """
+    (vBC, pICMS, vICMS) do item conforme o grupo de ICMS informado.
+    """
+    grupo_icms = imposto.find(NFE_NS + 'ICMS') if imposto is not None else None
+    icms = next(iter(grupo_icms), None) if grupo_icms is not None else None
+    if icms is None:
+        # Sem ICMS (ex.: item de serviço com ISSQN)
+        return 0.0, 0.0, 0.0
+
+    grupo = icms.tag[len(NFE_NS):]
+    if grupo in GRUPOS_ICMS_OBRIGATORIOS:
+        faltando = [campo for campo in CAMPOS_ICMS if _texto(icms, campo) is None]
+        if faltando:
+            raise ItemNfeInvalido(f"{grupo} sem {', '.join(faltando)}")
+        return tuple(_decimal(icms, campo) for campo in CAMPOS_ICMS)
+    if grupo in GRUPOS_ICMS_OPCIONAIS:
+        return tuple(_decimal(icms, campo, obrigatorio=False) for campo in CAMPOS_ICMS)
+    return 0.0, 0.0, 0.0
+
+
+def valores_ipi(imposto):
+    """
+    (vBC, pIPI, vIPI) do grupo IPITrib; zero para IPINT ou item sem IPI.
+    No IPITrib por unidade (qUnid/vUnid) só vIPI é exigido.
+    """
+    ipi = imposto.find(NFE_NS + 'IPI') if imposto is not None else None
+    ipi_trib = ipi.find(NFE_NS + 'IPITrib') if ipi is not None else None
+    if ipi_trib is None:
+        return 0.0, 0.0, 0.0
+    return (_decimal(ipi_trib, 'vBC', obrigatorio=False),
+            _decimal(ipi_trib, 'pIPI', obrigatorio=False),
+            _decimal(ipi_trib, 'vIPI'))
+
+
+def extrair_item_nfe(det):
+    """
+    Valida e converte um elemento <det> da NF-e num ItemNfe. Lança
+    ItemNfeInvalido com o motivo quando falta um dado obrigatório. A
+    validação é local, sem consulta a schemas ou serviços externos. NCM e
+    CFOP se repetem muito entre itens e são internados para compartilhar a
+    mesma string.
+    """
+    prod = det.find(NFE_NS + 'prod')
+    if prod is None:
+        raise ItemNfeInvalido("grupo prod ausente")
+    codigo = _texto(prod, 'cProd')
+    if not codigo:
+        raise ItemNfeInvalido("cProd ausente")
+
+    imposto = det.find(NFE_NS + 'imposto')
+    icms_base, icms_percentual, icms_valor = valores_icms(imposto)
+    ipi_base, ipi_percentual, ipi_valor = valores_ipi(imposto)
+
+    return ItemNfe(
+        codigo=codigo,
+        # Sem EAN vira '' para o upsert por (codigo, ean) encontrar o produto
+        ean=_texto(prod, 'cEAN') or '',
+        descricao=_texto(prod, 'xProd'),
+        ncm=_internar(_texto(prod, 'NCM')),
+        cfop=_internar(_texto(prod, 'CFOP')),
+        quantidade=_decimal(prod, 'qCom'),
+        preco_unitario=_decimal(prod, 'vUnCom'),
+        preco_total=_decimal(prod, 'vProd'),
+        icms_base=icms_base,
+        icms_percentual=icms_percentual,
+        icms_valor=icms_valor,
+        ipi_base=ipi_base,
+        ipi_percentual=ipi_percentual,
+        ipi_valor=ipi_valor
+    )
+
+
+def iterar_itens_nfe(file_path, rejeitados=None):
+    """
+    Percorre os itens <det> do XML em streaming, liberando cada elemento
+    depois de lido para manter a memória constante. Itens inválidos não
+    interrompem a leitura: são descritos em `rejeitados` (se informada) e
+    pulados.
+    """
+    tag_det = NFE_NS + 'det'
+    tag_inf = NFE_NS + 'infNFe'
+    inf_nfe = None
+
+    for evento, elemento in ET.iterparse(file_path, events=('start', 'end')):
+        if evento == 'start':
+            if elemento.tag == tag_inf:
+                inf_nfe = elemento
+            continue
+
+        if elemento.tag == tag_det:
+            try:
+                item = extrair_item_nfe(elemento)
+            except ItemNfeInvalido as e:
+                item = None
+                prod = elemento.find(NFE_NS + 'prod')
+                rejeitado = {
+                    'item': elemento.get('nItem'),
+                    'codigo': _texto(prod, 'cProd'),
+                    'descricao': _texto(prod, 'xProd'),
+                    'motivo': str(e),
                 }
+                logger.warning("Item rejeitado em %s: %s", os.path.basename(file_path), rejeitado)
+                if rejeitados is not None:
+                    rejeitados.append(rejeitado)
+            elemento.clear()
+            if inf_nfe is not None:
+                inf_nfe.remove(elemento)
+            if item is not None:
+                yield item
+
+
+def gravar_itens(cursor, itens, batch_size, apos_lote=None):
+    """
+    Insere os itens em lotes de `batch_size` e retorna o total gravado.
+    `apos_lote(gravados)`, se informada, é chamada após cada lote completo.
+    """
+    total = 0
+    lote = []
+    # Amostra de itens em DEBUG; com o nível desligado o custo é só este teste
+    amostragem = app.config['LOG_AMOSTRAGEM_ITENS'] if logger.isEnabledFor(logging.DEBUG) else 0
+    for numero, produto in enumerate(itens, start=1):
+        if amostragem and numero % amostragem == 0:
+            logger.debug("Item importado #%s: %s", numero, produto._asdict())
+        lote.append(produto)
+        if len(lote) >= batch_size:
+            cursor.executemany(SQL_INSERIR_PRODUTO, lote)
+            total += len(lote)
+            lote.clear()
+            if apos_lote:
+                apos_lote(total)
+
+    if lote:
+        cursor.executemany(SQL_INSERIR_PRODUTO, lote)
+        total += len(lote)
+    return total
+
+
+def hash_arquivo(file_path):
+    """
+    SHA-256 do conteúdo do arquivo, lido em blocos.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1024 * 1024), b''):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+
+def arquivo_ja_importado(cursor, hash_xml):
+    cursor.execute("SELECT 1 FROM imported_files WHERE hash = ?", (hash_xml,))
+    return cursor.fetchone() is not None
+
+
+def registrar_importacao(cursor, hash_xml, file_path, itens, rejeitados=()):
+    """
+    Marca o arquivo como importado e grava o relatório dos itens rejeitados.
+    """
+    arquivo = os.path.basename(file_path)
+    cursor.execute(
+        "INSERT OR REPLACE INTO imported_files (hash, arquivo, itens, rejeitados) VALUES (?, ?, ?, ?)",
+        (hash_xml, arquivo, itens, len(rejeitados))
+    )
+    cursor.execute("DELETE FROM itens_rejeitados WHERE hash = ?", (hash_xml,))
+    cursor.executemany(
+        "INSERT INTO itens_rejeitados (hash, arquivo, item, codigo, descricao, motivo) VALUES (?, ?, ?, ?, ?, ?)",
+        [(hash_xml, arquivo, r['item'], r['codigo'], r['descricao'], r['motivo']) for r in rejeitados]
+    )
+
+
+# Importação em lote: vários arquivos lidos em paralelo e um único gravador
+import zipfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from werkzeug.utils import secure_filename
+
+# Número de processos de leitura (None = número de CPUs)
+app.config['IMPORT_WORKERS'] = None
+
+# Intervalo máximo entre avisos de progresso enquanto os arquivos são lidos
+app.config['IMPORT_PROGRESSO_SEGUNDOS'] = 1.0
+
+
+def colunas_itens_nfe(itens):
+    """
+    Guarda os itens por coluna: listas para os textos (NCM/CFOP internados)
+    e array('d') para os números, sem um objeto float por valor. É o formato
+    que os processos de leitura devolvem ao processo principal.
+    """
+    colunas = ([[] for _ in range(TOTAL_CAMPOS_TEXTO_NFE)]
+               + [array('d') for _ in CAMPOS_ITEM_NFE[TOTAL_CAMPOS_TEXTO_NFE:]])
+    for item in itens:
+        for coluna, valor in zip(colunas, item):
+            coluna.append(valor)
+    return colunas
+
+
+def iterar_colunas_nfe(colunas):
+    """
+    Gera de volta os ItemNfe, um de cada vez, a partir das colunas.
+    """
+    return map(ItemNfe._make, zip(*colunas))
+
+
+def ler_itens_nfe(file_path):
+    """
+    Executada nos processos do pool: apenas lê o XML e devolve os itens
+    em colunas (ver colunas_itens_nfe) e os rejeitados, sem tocar no banco.
+    """
+    rejeitados = []
+    try:
+        return file_path, colunas_itens_nfe(iterar_itens_nfe(file_path, rejeitados)), rejeitados, None
+    except Exception as e:
+        return file_path, None, None, str(e)
+
+
+def importar_arquivos(caminhos, workers=None, batch_size=None, progresso=None):
+    """
+    Lê os arquivos em um pool de processos e grava todos os itens por uma
+    única conexão, evitando disputa de escrita no SQLite. Cada arquivo é
+    gravado na sua própria transação e recebe um resultado individual.
+
+    `progresso(itens_gravados, total_itens)`, se informado, é chamado a cada
+    lote gravado e a cada IMPORT_PROGRESSO_SEGUNDOS durante a leitura;
+    total_itens soma os itens dos arquivos já lidos. Nesse modo o que já foi
+    gravado é confirmado antes de cada chamada, para que o progresso (e um
+    cancelamento) não dependa do fim do arquivo; um arquivo interrompido não
+    é marcado como importado e a reimportação o completa pelo upsert.
+    """
+    workers = workers or app.config['IMPORT_WORKERS']
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    resultados = []
+    if not caminhos:
+        return resultados
+
+    inicio = time.perf_counter()
+    with get_db() as conn, ProcessPoolExecutor(max_workers=workers) as pool:
+        cursor = conn.cursor()
 
-                print(f"Inserindo produto: {produto}")  # Log do produto processado
-                cursor.execute('''
-                    INSERT INTO products (codigo, ean, descricao, ncm, cfop, quantidade, preco_unitario,
-                    preco_total, icms_base, icms_percentual, icms_valor,
-                    ipi_base, ipi_percentual, ipi_valor)
-                    VALUES (:codigo, :ean, :descricao, :ncm, :cfop, :quantidade, :preco_unitario,
-                    :preco_total, :icms_base, :icms_percentual, :icms_valor,
-                    :ipi_base, :ipi_percentual, :ipi_valor)
-                ''', produto)
+        # Arquivos já importados (ou repetidos no próprio lote) nem são lidos
+        hashes = {}
+        vistos = set()
+        for caminho in caminhos:
+            nome = os.path.basename(caminho)
+            hash_xml = hash_arquivo(caminho)
+            if hash_xml in vistos or arquivo_ja_importado(cursor, hash_xml):
+                resultados.append({'arquivo': nome, 'status': 'skipped', 'message': 'Arquivo já importado.'})
+            else:
+                hashes[caminho] = hash_xml
+                vistos.add(hash_xml)
+
+        futuros = {pool.submit(ler_itens_nfe, caminho): caminho for caminho in hashes}
+        gravados = total_itens = 0
+
+        def informar_progresso(gravados_arquivo=0):
             conn.commit()
-        print("XML processado com sucesso!")
+            progresso(gravados + gravados_arquivo, total_itens)
+
+        try:
+            pendentes = set(futuros)
+            while pendentes:
+                if progresso:
+                    informar_progresso()
+                concluidos, pendentes = wait(pendentes, timeout=app.config['IMPORT_PROGRESSO_SEGUNDOS'],
+                                             return_when=FIRST_COMPLETED)
+                for futuro in concluidos:
+                    caminho = futuros[futuro]
+                    nome = os.path.basename(caminho)
+                    try:
+                        _, colunas, rejeitados, erro = futuro.result()
+                    except BrokenProcessPool as e:
+                        colunas, rejeitados, erro = None, None, f"Falha no processo de leitura: {e}"
+
+                    if erro is not None:
+                        logger.error("Erro ao processar o XML %s: %s", nome, erro)
+                        resultados.append({'arquivo': nome, 'status': 'error', 'message': erro})
+                        continue
+
+                    total_itens += len(colunas[0])
+                    try:
+                        total = gravar_itens(cursor, iterar_colunas_nfe(colunas), batch_size,
+                                             informar_progresso if progresso else None)
+                        registrar_importacao(cursor, hashes[caminho], caminho, total, rejeitados)
+                        conn.commit()
+                        gravados += total
+                        resultados.append({'arquivo': nome, 'status': 'success', 'itens': total,
+                                           'rejeitados': len(rejeitados)})
+                    except sqlite3.Error as e:
+                        conn.rollback()
+                        logger.error("Erro ao gravar o XML %s: %s", nome, e)
+                        resultados.append({'arquivo': nome, 'status': 'error', 'message': str(e)})
+
+                    if progresso:
+                        informar_progresso()
+        except BaseException:
+            # Interrompido (ex.: job cancelado): descarta as leituras pendentes
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    duracao = time.perf_counter() - inicio
+    logger.info("Importação em lote concluída: %s arquivos, %s itens em %.2fs (pico de memória: %s MB)",
+                len(caminhos), sum(r.get('itens', 0) for r in resultados), duracao, pico_memoria_mb())
+    return resultados
+
+
+# Limite do total descompactado de cada ZIP enviado
+app.config['UPLOAD_ZIP_MAX_BYTES'] = 1024 * 1024 * 1024
+
+
+def salvar_uploads(arquivos):
+    """
+    Salva os arquivos enviados (XML ou ZIP com XMLs) numa subpasta própria
+    de UPLOAD_FOLDER e retorna os caminhos dos XMLs a importar. Cada XML
+    fica numa subpasta numerada, para que arquivos de mesmo nome (ex.:
+    fornecedor1/nfe.xml e fornecedor2/nfe.xml num ZIP) não se sobrescrevam.
+    Lança ValueError se um ZIP descompactado passar de UPLOAD_ZIP_MAX_BYTES.
+    """
+    pasta_lote = tempfile.mkdtemp(prefix='lote_', dir=app.config['UPLOAD_FOLDER'])
+    caminhos = []
+
+    def destino_unico(nome):
+        pasta = os.path.join(pasta_lote, str(len(caminhos)))
+        os.mkdir(pasta)
+        return os.path.join(pasta, nome)
+
+    try:
+        for arquivo in arquivos:
+            nome = secure_filename(arquivo.filename or '')
+            if not nome:
+                continue
+
+            if nome.lower().endswith('.zip'):
+                with zipfile.ZipFile(arquivo.stream) as pacote:
+                    membros = [
+                        membro for membro in pacote.infolist()
+                        if not membro.is_dir()
+                        and secure_filename(os.path.basename(membro.filename)).lower().endswith('.xml')
+                    ]
+                    # file_size é o tamanho declarado; a leitura do membro
+                    # não devolve mais bytes do que isso
+                    if sum(membro.file_size for membro in membros) > app.config['UPLOAD_ZIP_MAX_BYTES']:
+                        raise ValueError(f"{nome}: conteúdo descompactado maior que o permitido.")
+                    for membro in membros:
+                        destino = destino_unico(secure_filename(os.path.basename(membro.filename)))
+                        with pacote.open(membro) as origem, open(destino, 'wb') as saida:
+                            shutil.copyfileobj(origem, saida)
+                        caminhos.append(destino)
+            elif nome.lower().endswith('.xml'):
+                destino = destino_unico(nome)
+                arquivo.save(destino)
+                caminhos.append(destino)
+    except (ValueError, zipfile.BadZipFile):
+        shutil.rmtree(pasta_lote, ignore_errors=True)
+        raise
+    return caminhos
+
+
+@app.route('/upload', methods=['GET', 'POST'])
+def upload():
+    if request.method == 'POST':
+        try:
+            caminhos = salvar_uploads(request.files.getlist('file'))
+        except (ValueError, zipfile.BadZipFile) as e:
+            flash(f"Erro: {e}", "error")
+            return redirect(request.url)
+        if not caminhos:
+            flash("Erro: Nenhum arquivo XML válido foi enviado.", "error")
+            return redirect(request.url)
+
+        for resultado in importar_arquivos(caminhos):
+            if resultado['status'] == 'success':
+                flash(f"{resultado['arquivo']}: {resultado['itens']} itens importados.", "success")
+                if resultado['rejeitados']:
+                    flash(f"{resultado['arquivo']}: {resultado['rejeitados']} itens rejeitados "
+                          f"(ver /importacoes).", "warning")
+            elif resultado['status'] == 'skipped':
+                flash(f"{resultado['arquivo']}: {resultado['message']}", "warning")
+            else:
+                flash(f"{resultado['arquivo']}: {resultado['message']}", "error")
+        return redirect(request.url)
+
+    return render_template('upload.html')
+
+
+@app.route('/importar_lote', methods=['POST'])
+def importar_lote():
+    """
+    Importa vários XMLs (ou ZIPs de XMLs) de uma vez e retorna o resultado
+    de cada arquivo. Com `assincrono=1` a importação vira um job e a
+    resposta traz apenas o id para acompanhamento em /jobs/<id>.
+    """
+    try:
+        caminhos = salvar_uploads(request.files.getlist('files'))
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not caminhos:
+        return jsonify({'status': 'error', 'message': 'Nenhum arquivo XML enviado.'}), 400
+
+    try:
+        if request.form.get('assincrono'):
+            job_id = enfileirar_job('importar_xml', {'arquivos': caminhos})
+            return jsonify({'status': 'success', 'job_id': job_id,
+                            'url': url_for('status_job', job_id=job_id)}), 202
+
+        resultados = importar_arquivos(caminhos)
+        falhas = sum(1 for r in resultados if r['status'] == 'error')
+        importados = sum(1 for r in resultados if r['status'] == 'success')
+        return jsonify({
+            'status': 'success' if not falhas else 'partial',
+            'message': f"{importados} de {len(resultados)} arquivos importados.",
+            'resultados': resultados
+        })
     except Exception as e:
-        print(f"Erro ao processar o XML: {e}")
-
-def gerar_nome_comercial(produto_dict):
-    # Garantir que todos os campos sejam strings válidas
-    partes = [
-        produto_dict.get('categoria', '').strip() or 'Sem Categoria',
-        produto_dict.get('marca', '').strip() or 'Sem Marca',
-        produto_dict.get('modelo', '').strip() or 'Sem Modelo',
-        produto_dict.get('cor', '').strip() or 'Sem Cor',
-        produto_dict.get('faixa_etaria', '').strip() or 'Sem Faixa Etária',
-        produto_dict.get('genero', '').strip() or 'Sem Gênero'
-    ]
-    # Retornar o nome comercial com as partes separadas por espaços
-    return ' '.join(partes).strip()
+        logger.exception("Erro na importação em lote: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+
+@app.route('/importacoes', methods=['GET'])
+def importacoes():
+    """
+    Arquivos importados, com a quantidade de itens gravados e rejeitados.
+    """
+    cursor = get_db().execute("""
+        SELECT hash, arquivo, itens, rejeitados, importado_em
+        FROM imported_files
+        ORDER BY importado_em DESC
+        LIMIT 200
+    """)
+    colunas = ('hash', 'arquivo', 'itens', 'rejeitados', 'importado_em')
+    return jsonify({'status': 'success', 'importacoes': [dict(zip(colunas, linha)) for linha in cursor]})
+
+
+@app.route('/importacoes/<hash_xml>/rejeitados', methods=['GET'])
+def itens_rejeitados(hash_xml):
+    """
+    Relatório dos itens rejeitados de um arquivo (pelo hash).
+    """
+    cursor = get_db().execute("""
+        SELECT arquivo, item, codigo, descricao, motivo
+        FROM itens_rejeitados
+        WHERE hash = ?
+        ORDER BY id
+    """, (hash_xml,))
+    colunas = ('arquivo', 'item', 'codigo', 'descricao', 'motivo')
+    return jsonify({'status': 'success', 'rejeitados': [dict(zip(colunas, linha)) for linha in cursor]})
+
+
+# Recebimento de um XML pelo corpo bruto da requisição (POST /api/nfe).
+# O mesmo fluxo é servido sem ocupar threads pelo asgi.py.
+app.config['NFE_CHUNK_SIZE'] = 64 * 1024
+app.config['NFE_MAX_BYTES'] = 200 * 1024 * 1024
+
+
+def nome_arquivo_nfe(nome):
+    """
+    Nome seguro para o XML recebido. Lança ValueError se não for .xml.
+    """
+    nome = secure_filename(nome or '') or 'nfe.xml'
+    if not nome.lower().endswith('.xml'):
+        raise ValueError("Envie um arquivo .xml.")
+    return nome
+
+
+def destino_nfe(nome):
+    """
+    Caminho do XML numa subpasta própria de UPLOAD_FOLDER.
+    """
+    pasta_lote = tempfile.mkdtemp(prefix='lote_', dir=app.config['UPLOAD_FOLDER'])
+    return os.path.join(pasta_lote, nome)
+
+
+@app.route('/api/nfe', methods=['POST'])
+def receber_nfe():
+    """
+    Grava o corpo da requisição (um XML de NF-e) em disco, em blocos, e
+    enfileira a importação. Retorna 202 com o id do job.
+    Uso: curl --data-binary @nota.xml '/api/nfe?nome=nota.xml'
+    """
+    try:
+        destino = destino_nfe(nome_arquivo_nfe(request.args.get('nome')))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    limite = app.config['NFE_MAX_BYTES']
+    recebidos = 0
+    with open(destino, 'wb') as saida:
+        while recebidos <= limite:
+            bloco = request.stream.read(app.config['NFE_CHUNK_SIZE'])
+            if not bloco:
+                break
+            recebidos += len(bloco)
+            saida.write(bloco)
+
+    if not recebidos or recebidos > limite:
+        shutil.rmtree(os.path.dirname(destino), ignore_errors=True)
+        if recebidos:
+            return jsonify({'status': 'error', 'message': 'Arquivo maior que o permitido.'}), 413
+        return jsonify({'status': 'error', 'message': 'Nenhum conteúdo enviado.'}), 400
+
+    job_id = enfileirar_job('importar_xml', {'arquivos': [destino]})
+    return jsonify({'status': 'success', 'job_id': job_id,
+                    'url': url_for('status_job', job_id=job_id)}), 202
+
+@app.cli.command('importar-xml')
+@click.argument('pasta', required=False)
+@click.option('--workers', type=int, default=None, help='Número de processos de leitura.')
+@click.option('--batch-size', type=int, default=None, help='Itens por executemany.')
+def importar_xml_command(pasta, workers, batch_size):
+    """
+    Importa todos os XMLs de uma pasta (padrão: UPLOAD_FOLDER).
+    """
+    init_db()
+    pasta = pasta or app.config['UPLOAD_FOLDER']
+    caminhos = sorted(
+        os.path.join(pasta, nome) for nome in os.listdir(pasta)
+        if nome.lower().endswith('.xml')
+    )
+    for resultado in importar_arquivos(caminhos, workers=workers, batch_size=batch_size):
+        if resultado['status'] == 'success':
+            click.echo(f"OK    {resultado['arquivo']}: {resultado['itens']} itens"
+                       + (f", {resultado['rejeitados']} rejeitados" if resultado['rejeitados'] else ""))
+        elif resultado['status'] == 'skipped':
+            click.echo(f"PULO  {resultado['arquivo']}: {resultado['message']}")
+        else:
+            click.echo(f"ERRO  {resultado['arquivo']}: {resultado['message']}")
+
+# Partes do nome comercial, na ordem em que são concatenadas
+PARTES_NOME_COMERCIAL = ('categoria', 'marca', 'modelo', 'cor', 'faixa_etaria', 'genero')
+
+# Nome comercial em SQL (atualização em massa): as partes concatenadas, ou
+# 'Sem Informações' se todas estiverem vazias
+SQL_NOME_COMERCIAL = "COALESCE(NULLIF(TRIM({}), ''), 'Sem Informações')".format(
+    " || ' ' || ".join(f"COALESCE({parte}, '')" for parte in PARTES_NOME_COMERCIAL)
+)
+
+# Cache em memória das tabelas de apoio custom_fields e custom_values.
+# As entradas são identificadas pela versão guardada no banco (cache_versao),
+# incrementada por triggers a cada escrita nessas tabelas; assim a escrita
+# feita por um processo invalida o cache de todos. A versão é lida (uma busca
+# pela chave primária) antes de cada consulta ao cache.
+from collections import OrderedDict
+
+app.config['CACHE_CAMPOS_MAX'] = 64  # Máximo de entradas (None = sem limite)
+
+_cache_campos = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_estado = {'versao': None, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def invalidar_cache_campos():
+    """
+    Libera as entradas deste processo. A invalidação entre processos vem da
+    versão no banco; esta chamada apenas antecipa a liberação da memória.
+    """
+    with _cache_lock:
+        _cache_campos.clear()
+
+
+def versao_cache_campos():
+    return get_db().execute("SELECT versao FROM cache_versao WHERE id = 1").fetchone()[0]
+
+
+def consultar_cache_campos(chave, carregar):
+    """
+    Retorna o valor em cache para `chave` ou o carrega com `carregar()`,
+    descartando a entrada menos usada quando o limite é atingido.
+    """
+    versao = versao_cache_campos()
+    with _cache_lock:
+        if versao != _cache_estado['versao']:
+            # Houve escrita (neste ou em outro processo): descarta o conteúdo
+            _cache_estado['versao'] = versao
+            _cache_campos.clear()
+        item = _cache_campos.get((versao, chave))
+        if item is not None:
+            _cache_campos.move_to_end((versao, chave))
+            _cache_estado['hits'] += 1
+            return item
+        _cache_estado['misses'] += 1
+
+    item = carregar()
+
+    with _cache_lock:
+        # Não guarda o resultado se outra thread já viu uma versão mais nova
+        if versao == _cache_estado['versao']:
+            _cache_campos[(versao, chave)] = item
+            limite = app.config['CACHE_CAMPOS_MAX']
+            while limite is not None and len(_cache_campos) > limite:
+                _cache_campos.popitem(last=False)
+                _cache_estado['evictions'] += 1
+    return item
+
+
+def estatisticas_cache_campos():
+    with _cache_lock:
+        return dict(_cache_estado, entradas=len(_cache_campos))
+
+
+def obter_campos_personalizados():
+    """
+    Lista de (id, nome, tipo) de todos os campos personalizados.
+    """
+    def carregar():
+        return get_db().execute("SELECT id, nome, tipo FROM custom_fields").fetchall()
+    return consultar_cache_campos('campos', carregar)
+
+
+def obter_valores_personalizados():
+    """
+    Dicionário {campo_id: [{"id": valor_id, "valor": texto}, ...]}.
+    """
+    def carregar():
+        valores_personalizados = {}
+        for campo_id, valor_id, valor in get_db().execute("SELECT campo_id, id, valor FROM custom_values"):
+            if campo_id not in valores_personalizados:
+                valores_personalizados[campo_id] = []
+            valores_personalizados[campo_id].append({"id": valor_id, "valor": valor})
+        return valores_personalizados
+    return consultar_cache_campos('valores', carregar)
+
+
+@app.route('/api/cache_campos', methods=['GET'])
+def api_cache_campos():
+    return jsonify(estatisticas_cache_campos())
 
-def gerar_nome_comercial(produto_dict):
-    print(f"Recebendo produto_dict: {produto_dict}")
-    nome_comercial = f"{produto_dict['categoria']} {produto_dict['marca']} {produto_dict['modelo']} {produto_dict['cor']} {produto_dict['faixa_etaria']} {produto_dict['genero']}".strip()
-    print(f"Gerado nome_comercial: {nome_comercial}")
-    return nome_comercial if nome_comercial else "Sem Informações"
 
 # Rota para gerenciar valores de campos personalizados
 
 @app.route('/custom_fields', methods=['GET', 'POST'])
 def custom_fields():
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         cursor = conn.cursor()
 
         if request.method == 'POST':
@@ -195,12 +1572,12 @@ def custom_fields():
                 try:
                     cursor.execute("INSERT INTO custom_fields (nome, tipo) VALUES (?, ?)", (nome.strip(), tipo))
                     conn.commit()
+                    invalidar_cache_campos()
                     flash(f"Campo '{nome}' criado com sucesso!", "success")
                 except sqlite3.Error as e:
                     flash(f"Erro ao criar campo: {e}", "error")
 
-        cursor.execute("SELECT id, nome, tipo FROM custom_fields")
-        campos = cursor.fetchall()
+        campos = obter_campos_personalizados()
 
     return render_template('custom_fields.html', campos=campos)
 
@@ -208,7 +1585,7 @@ def custom_fields():
 @app.route('/editar_campo/<int:campo_id>', methods=['GET', 'POST'])
 def editar_campo(campo_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
 
             if request.method == 'POST':
@@ -221,6 +1598,7 @@ def editar_campo(campo_id):
 
                 cursor.execute("UPDATE custom_fields SET nome = ?, tipo = ? WHERE id = ?", (novo_nome, tipo, campo_id))
                 conn.commit()
+                invalidar_cache_campos()
                 flash("Campo atualizado com sucesso!", "success")
                 return redirect(url_for('custom_fields'))
 
@@ -237,57 +1615,51 @@ def editar_campo(campo_id):
     except Exception as e:
         flash(f"Erro ao editar o campo: {e}", "error")
         return redirect(url_for('custom_fields'))
-    
-@app.route('/atualizar_nome_comercial', methods=['POST'])
-def atualizar_nome_comercial():
-    try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-
-            # Selecionar todos os produtos
-            cursor.execute("""
-                SELECT id, categoria, marca, modelo, cor, faixa_etaria, genero 
-                FROM products
-            """)
-            produtos = cursor.fetchall()
-
-            total_atualizados = 0
-            for produto in produtos:
-                produto_id = produto[0]
-                produto_dict = {
-                    "categoria": produto[1] if produto[1] else '',
-                    "marca": produto[2] if produto[2] else '',
-                    "modelo": produto[3] if produto[3] else '',
-                    "cor": produto[4] if produto[4] else '',
-                    "faixa_etaria": produto[5] if produto[5] else '',
-                    "genero": produto[6] if produto[6] else ''
-                }
-                nome_comercial = gerar_nome_comercial(produto_dict)
-                cursor.execute("""
-                    UPDATE products 
-                    SET nome_comercial = ? 
-                    WHERE id = ?
-                """, (nome_comercial, produto_id))
-                total_atualizados += 1
-
-                # Log para debug
-                print(f"Produto ID {produto_id} atualizado com Nome Comercial: {nome_comercial}")
-
+    
+@app.route('/atualizar_nome_comercial', methods=['POST'])
+def atualizar_nome_comercial():
+    """
+    Recalcula o nome comercial em um único UPDATE. Com modo=incremental,
+    apenas os produtos marcados como pendentes (atributos alterados desde a
+    última execução) são recalculados.
+    """
+    incremental = request.values.get('modo') == 'incremental'
+    try:
+        with get_db() as conn:
+            total_atualizados = recalcular_nomes_comerciais(conn.cursor(), incremental)
             conn.commit()
             flash(f"Nomes comerciais atualizados com sucesso! Total: {total_atualizados}", "success")
     except Exception as e:
-        print(f"Erro ao atualizar nomes comerciais: {e}")
+        logger.exception("Erro ao atualizar nomes comerciais: %s", e)
         flash("Erro ao atualizar nomes comerciais.", "error")
 
     return redirect(url_for('produtos'))
 
 
+def recalcular_nomes_comerciais(cursor, incremental=False):
+    """
+    Atualiza nome_comercial de forma set-based e limpa a marca de pendência.
+    Só os produtos cujo nome muda são gravados (e têm a versão incrementada).
+    Retorna a quantidade de produtos atualizados.
+    """
+    filtro = "AND nome_comercial_pendente = 1" if incremental else ""
+    cursor.execute(f"""
+        UPDATE products
+        SET nome_comercial = {SQL_NOME_COMERCIAL},
+            versao = versao + 1
+        WHERE nome_comercial IS NOT ({SQL_NOME_COMERCIAL}) {filtro}
+    """)
+    atualizados = cursor.rowcount
+    cursor.execute("UPDATE products SET nome_comercial_pendente = 0 WHERE nome_comercial_pendente = 1")
+    return atualizados
+
+
 
 # Rota para editar um valor de campo personalizado
 @app.route('/editar_valor/<int:valor_id>', methods=['GET', 'POST'])
 def editar_valor(valor_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_db() as conn:
             cursor = conn.cursor()
 
             if request.method == 'POST':
@@ -299,6 +1671,7 @@ def editar_valor(valor_id):
 
                 cursor.execute("UPDATE custom_values SET valor = ? WHERE id = ?", (novo_valor, valor_id))
                 conn.commit()
+                invalidar_cache_campos()
                 flash("Valor atualizado com sucesso!", "success")
                 return redirect(url_for('custom_fields'))
 
@@ -319,27 +1692,50 @@ def editar_valor(valor_id):
 
 @app.route('/excluir_campo/<int:campo_id>', methods=['POST'])
 def excluir_campo(campo_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute("DELETE FROM custom_values WHERE campo_id = ?", (campo_id,))
             cursor.execute("DELETE FROM product_custom_field_values WHERE campo_id = ?", (campo_id,))
             cursor.execute("DELETE FROM custom_fields WHERE id = ?", (campo_id,))
             conn.commit()
+            invalidar_cache_campos()
             flash("Campo excluído com sucesso!", "success")
         except sqlite3.Error as e:
             flash(f"Erro ao excluir o campo: {e}", "error")
 
     return redirect(url_for('custom_fields'))
 
+@app.route('/excluir_valor/<int:valor_id>', methods=['POST'])
+def excluir_valor(valor_id):
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT campo_id FROM custom_values WHERE id = ?", (valor_id,))
+            valor = cursor.fetchone()
+            if not valor:
+                flash("Erro: Valor não encontrado.", "error")
+                return redirect(url_for('custom_fields'))
+
+            cursor.execute("DELETE FROM product_custom_field_values WHERE valor_id = ?", (valor_id,))
+            cursor.execute("DELETE FROM custom_values WHERE id = ?", (valor_id,))
+            conn.commit()
+            invalidar_cache_campos()
+            flash("Valor excluído com sucesso!", "success")
+        except sqlite3.Error as e:
+            flash(f"Erro ao excluir o valor: {e}", "error")
+            return redirect(url_for('custom_fields'))
+
+    return redirect(url_for('custom_field_values', campo_id=valor[0]))
+
 @app.route('/custom_fields/<int:campo_id>/values', methods=['GET', 'POST'])
 def custom_field_values(campo_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with get_db() as conn:
         cursor = conn.cursor()
 
-        # Verificar campo específico
-        cursor.execute("SELECT id, nome FROM custom_fields WHERE id = ?", (campo_id,))
-        campo = cursor.fetchone()
+        # Verificar campo específico direto no banco (não no cache), pois a
+        # rota também grava
+        campo = cursor.execute("SELECT id, nome, tipo FROM custom_fields WHERE id = ?", (campo_id,)).fetchone()
         if not campo:
             flash("Campo não encontrado!", "error")
             return redirect(url_for('custom_fields'))
@@ -350,59 +1746,501 @@ def custom_field_values(campo_id):
             if valor:
                 cursor.execute("INSERT INTO custom_values (campo_id, valor) VALUES (?, ?)", (campo_id, valor))
                 conn.commit()
+                invalidar_cache_campos()
                 flash(f"Valor '{valor}' adicionado com sucesso!", "success")
             else:
                 flash("Erro: O valor não pode estar vazio!", "error")
 
         # Recuperar os valores existentes
-        cursor.execute("SELECT id, valor FROM custom_values WHERE campo_id = ?", (campo_id,))
-        valores = cursor.fetchall()
+        valores = [(v['id'], v['valor']) for v in obter_valores_personalizados().get(campo_id, [])]
 
     return render_template('custom_field_values.html', campo=campo, valores=valores)
 
 
+# Listagem paginada de produtos (keyset pela coluna id)
+COLUNAS_LISTAGEM = ('id', 'codigo', 'ean', 'descricao', 'categoria', 'marca', 'modelo',
+                    'cor', 'faixa_etaria', 'genero', 'nome_comercial', 'versao')
+FILTROS_PRODUTOS = ('categoria', 'marca', 'modelo', 'cor', 'genero')
+
+app.config['PRODUTOS_PAGE_SIZE'] = 100
+app.config['PRODUTOS_MAX_PAGE_SIZE'] = 500
+
+
+def ler_parametros_listagem(args):
+    """
+    Extrai cursor, tamanho da página e filtros da query string.
+    Filtros de campos personalizados usam o formato campo_<campo_id>=<valor_id>.
+    Lança ValueError para parâmetros numéricos inválidos.
+    """
+    after = int(args.get('after') or 0)
+    limit = int(args.get('limit') or app.config['PRODUTOS_PAGE_SIZE'])
+    limit = max(1, min(limit, app.config['PRODUTOS_MAX_PAGE_SIZE']))
+
+    filtros, filtros_campos = ler_filtros_produtos(args)
+    return after, limit, filtros, filtros_campos
+
+
+def ler_filtros_produtos(args):
+    """
+    Separa os filtros de colunas de products e os de campos personalizados
+    (campo_<campo_id>=<valor_id>) de um dicionário de parâmetros.
+    """
+    filtros = {coluna: args[coluna] for coluna in FILTROS_PRODUTOS if args.get(coluna)}
+    filtros_campos = {
+        int(chave[len('campo_'):]): int(valor)
+        for chave, valor in args.items()
+        if chave.startswith('campo_') and valor
+    }
+    return filtros, filtros_campos
+
+
+def montar_filtros_produtos(filtros=None, filtros_campos=None, tabela='products'):
+    """
+    Retorna (condicoes, parametros) SQL sobre a tabela products (ou o alias
+    informado em `tabela`).
+    """
+    condicoes = []
+    parametros = []
+
+    for coluna, valor in (filtros or {}).items():
+        condicoes.append(f"{tabela}.{coluna} = ?")
+        parametros.append(valor)
+
+    for campo_id, valor_id in (filtros_campos or {}).items():
+        condicoes.append(f"""EXISTS (
+            SELECT 1 FROM product_custom_field_values
+            WHERE produto_id = {tabela}.id AND campo_id = ? AND valor_id = ?
+        )""")
+        parametros.extend((campo_id, valor_id))
+
+    return condicoes, parametros
+
+
+def buscar_pagina_produtos(cursor, after=0, limit=None, filtros=None, filtros_campos=None):
+    """
+    Retorna (produtos, proximo_after) com no máximo `limit` produtos de id
+    maior que `after`. Cada produto é um dict com as colunas da listagem e
+    'valores': {campo_id: {'id': valor_id, 'valor': texto}}.
+    """
+    limit = limit or app.config['PRODUTOS_PAGE_SIZE']
+    condicoes, parametros = montar_filtros_produtos(filtros, filtros_campos)
+    condicoes.insert(0, "id > ?")
+    parametros.insert(0, after)
+
+    # Busca um registro a mais apenas para saber se existe próxima página
+    cursor.execute(f"""
+        SELECT {', '.join(COLUNAS_LISTAGEM)}
+        FROM products
+        WHERE {' AND '.join(condicoes)}
+        ORDER BY id
+        LIMIT ?
+    """, parametros + [limit + 1])
+    linhas = cursor.fetchall()
+
+    proximo = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        proximo = linhas[-1][0]
+
+    produtos = [dict(zip(COLUNAS_LISTAGEM, linha), valores={}) for linha in linhas]
+    if produtos:
+        por_id = {produto['id']: produto for produto in produtos}
+        cursor.execute(f"""
+            SELECT pv.produto_id, pv.campo_id, pv.valor_id, cv.valor
+            FROM product_custom_field_values pv
+            LEFT JOIN custom_values cv ON cv.id = pv.valor_id
+            WHERE pv.produto_id IN ({', '.join('?' * len(por_id))})
+        """, list(por_id))
+        for produto_id, campo_id, valor_id, valor in cursor.fetchall():
+            por_id[produto_id]['valores'][campo_id] = {'id': valor_id, 'valor': valor}
+
+    return produtos, proximo
+
+
+@app.route('/api/produtos', methods=['GET'])
+def api_produtos():
+    """
+    Página de produtos em JSON. Use o campo 'next_after' da resposta como
+    parâmetro 'after' para buscar a página seguinte.
+    """
+    try:
+        after, limit, filtros, filtros_campos = ler_parametros_listagem(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Parâmetros de paginação inválidos.'}), 400
+
+    try:
+        with get_db() as conn:
+            produtos, proximo = buscar_pagina_produtos(conn.cursor(), after, limit, filtros, filtros_campos)
+        return jsonify({'status': 'success', 'produtos': produtos, 'next_after': proximo})
+    except sqlite3.Error as e:
+        logger.error("Erro no banco de dados: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+app.config['BUSCA_LIMITE'] = 20
+
+
+def montar_consulta_fts(texto):
+    """
+    Converte o texto digitado em uma consulta FTS5 com prefixo em cada termo
+    ("cami azu" -> "cami"* "azu"*), escapando aspas e operadores.
+    """
+    termos = [termo.replace('"', '""') for termo in texto.split()]
+    return ' '.join(f'"{termo}"*' for termo in termos if termo)
+
+
+@app.route('/api/produtos/busca', methods=['GET'])
+def buscar_produtos():
+    """
+    Busca textual por descrição, nome comercial, marca e valores
+    personalizados, ordenada por relevância (bm25).
+    """
+    consulta = montar_consulta_fts(request.args.get('q', ''))
+    if not consulta:
+        return jsonify({'status': 'error', 'message': 'Informe o termo de busca (q).'}), 400
+
+    try:
+        limite = max(1, min(int(request.args.get('limit') or app.config['BUSCA_LIMITE']),
+                            app.config['PRODUTOS_MAX_PAGE_SIZE']))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Parâmetro limit inválido.'}), 400
+
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # Pesos do bm25 por coluna: descricao, nome_comercial, marca, valores
+            cursor.execute("""
+                SELECT p.id, p.codigo, p.ean, p.descricao, p.nome_comercial, p.marca,
+                       bm25(products_fts, 1.0, 2.0, 1.5, 1.0) AS score
+                FROM products_fts
+                JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+            """, (consulta, limite))
+            colunas = ('id', 'codigo', 'ean', 'descricao', 'nome_comercial', 'marca', 'score')
+            resultados = [dict(zip(colunas, linha)) for linha in cursor.fetchall()]
+        return jsonify({'status': 'success', 'produtos': resultados})
+    except sqlite3.Error as e:
+        logger.error("Erro na busca de produtos: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+def consulta_produtos_pivotada(campos, colunas, filtros=None, filtros_campos=None, after=None, limit=None):
+    """
+    Monta o SELECT de products com as `colunas` informadas seguidas de uma
+    coluna por campo personalizado com o valor atribuído ao produto (pivô
+    por subconsulta correlacionada, que usa o índice único
+    produto_id/campo_id). Retorna (sql, parametros).
+    """
+    selecao = [f"p.{coluna}" for coluna in colunas]
+    parametros = []
+    for campo in campos:
+        selecao.append("""(SELECT cv.valor
+            FROM product_custom_field_values pv
+            JOIN custom_values cv ON cv.id = pv.valor_id
+            WHERE pv.produto_id = p.id AND pv.campo_id = ?)""")
+        parametros.append(campo[0])
+
+    condicoes, parametros_filtro = montar_filtros_produtos(filtros, filtros_campos, tabela='p')
+    if after is not None:
+        condicoes.insert(0, "p.id > ?")
+        parametros_filtro.insert(0, after)
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    sql = f"""
+        SELECT {', '.join(selecao)}
+        FROM products p
+        {where}
+        ORDER BY p.id
+    """
+    parametros += parametros_filtro
+    if limit is not None:
+        sql += " LIMIT ?"
+        parametros.append(limit)
+    return sql, parametros
+
+
+def iterar_pagina_pivotada(cursor, campos, after, limit, filtros, filtros_campos, pagina):
+    """
+    Gera as linhas da página (colunas da listagem + um valor por campo)
+    direto do cursor. Ao final, pagina['proximo'] recebe o cursor da página
+    seguinte, ou None se esta for a última.
+    """
+    sql, parametros = consulta_produtos_pivotada(
+        campos, COLUNAS_LISTAGEM, filtros, filtros_campos, after=after, limit=limit + 1
+    )
+    cursor.execute(sql, parametros)
+    ultimo_id = None
+    for numero, linha in enumerate(cursor, start=1):
+        if numero > limit:
+            pagina['proximo'] = ultimo_id
+            break
+        ultimo_id = linha[0]
+        yield linha
+
+
 @app.route('/produtos', methods=['GET'])
 def produtos():
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
+        after, limit, filtros, filtros_campos = ler_parametros_listagem(request.args)
+    except ValueError:
+        flash("Parâmetros de paginação inválidos.", "error")
+        return redirect(url_for('produtos'))
 
-            # Consultar produtos
-            cursor.execute("""
-                SELECT id, codigo, ean, descricao, categoria, marca, modelo, cor, faixa_etaria, genero, nome_comercial
-                FROM products
-            """)
-            produtos = cursor.fetchall()
-
-            # Consultar campos personalizados
-            cursor.execute("SELECT id, nome FROM custom_fields")
-            campos_personalizados = cursor.fetchall()
-
-            # Consultar valores de campos personalizados
-            cursor.execute("SELECT campo_id, id, valor FROM custom_values")
-            valores_brutos = cursor.fetchall()
-
-            valores_personalizados = {}
-            for campo_id, valor_id, valor in valores_brutos:
-                if campo_id not in valores_personalizados:
-                    valores_personalizados[campo_id] = []
-                valores_personalizados[campo_id].append({"id": valor_id, "valor": valor})
-
-        # Renderizar template
-        return render_template(
-            'produtos.html',
-            produtos=produtos,
-            campos_personalizados=campos_personalizados,
-            valores_personalizados=valores_personalizados
-        )
+    try:
+        # Campos e valores personalizados vêm do cache em memória
+        campos_personalizados = obter_campos_personalizados()
+        valores_personalizados = obter_valores_personalizados()
     except sqlite3.Error as e:
-        print(f"Erro no banco de dados: {e}")
+        logger.error("Erro no banco de dados: %s", e)
         flash("Erro ao carregar os produtos.", "error")
         return redirect(url_for('index'))
-    except Exception as e:
-        print(f"Erro geral: {e}")
-        flash("Erro desconhecido ao acessar a página de produtos.", "error")
-        return redirect(url_for('index'))
+
+    # As linhas são lidas do cursor enquanto o HTML é enviado; as demais
+    # páginas vêm de /api/produtos
+    pagina = {'proximo': None}
+    produtos = iterar_pagina_pivotada(
+        get_db().cursor(), campos_personalizados, after, limit, filtros, filtros_campos, pagina
+    )
+    return stream_template(
+        'produtos.html',
+        produtos=produtos,
+        pagina=pagina,
+        filtros=filtros,
+        filtros_campos=filtros_campos,
+        campos_personalizados=campos_personalizados,
+        valores_personalizados=valores_personalizados,
+        colunas=COLUNAS_LISTAGEM[1:-1],
+        campos_editaveis=CAMPOS_EDITAVEIS
+    )
+
+
+@app.route('/api/facetas', methods=['GET'])
+def facetas():
+    """
+    Contagem de produtos por categoria, marca, cor, faixa etária, gênero e
+    por valor de cada campo personalizado. Lê apenas as tabelas de facetas,
+    sem varrer products.
+    """
+    try:
+        conn = get_db()
+        resultado = {coluna: [] for coluna in COLUNAS_FACETAS}
+        for coluna, valor, total in conn.execute("""
+            SELECT coluna, valor, total FROM facetas_produtos
+            WHERE total > 0
+            ORDER BY coluna, total DESC, valor
+        """):
+            resultado[coluna].append({'valor': valor, 'total': total})
+
+        # Nomes de campos e valores vêm do cache em memória
+        nomes_valores = {
+            valor['id']: valor['valor']
+            for valores in obter_valores_personalizados().values() for valor in valores
+        }
+        campos = {
+            campo_id: {'campo_id': campo_id, 'nome': nome, 'valores': []}
+            for campo_id, nome, _ in obter_campos_personalizados()
+        }
+        for campo_id, valor_id, total in conn.execute("""
+            SELECT campo_id, valor_id, total FROM facetas_valores
+            WHERE total > 0
+            ORDER BY campo_id, total DESC
+        """):
+            if campo_id in campos and valor_id in nomes_valores:
+                campos[campo_id]['valores'].append(
+                    {'valor_id': valor_id, 'valor': nomes_valores[valor_id], 'total': total}
+                )
+        resultado['campos'] = list(campos.values())
+        return jsonify({'status': 'success', 'facetas': resultado})
+    except sqlite3.Error as e:
+        logger.error("Erro ao carregar as facetas: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.cli.command('reconstruir-facetas')
+def reconstruir_facetas_command():
+    """
+    Recalcula as contagens das facetas a partir dos dados atuais.
+    """
+    init_db()
+    with get_db() as conn:
+        reconstruir_facetas(conn.cursor())
+    click.echo("Facetas recalculadas.")
+
+
+# Exportação do catálogo enriquecido (produtos + valores personalizados)
+import csv
+import io
+
+from flask import Response, stream_with_context
+
+try:
+    from openpyxl import Workbook  # Opcional, necessário apenas para XLSX
+except ImportError:
+    Workbook = None
+
+COLUNAS_EXPORTACAO = ('id',) + tuple(nome for nome, _ in COLUNAS_PRODUCTS)
+FORMATOS_EXPORTACAO = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+
+
+def iterar_linhas(cursor, chunk_size):
+    """
+    Gera as linhas do cursor lendo em blocos com fetchmany, para percorrer
+    consultas grandes com memória limitada a um bloco.
+    """
+    while True:
+        linhas = cursor.fetchmany(chunk_size)
+        if not linhas:
+            break
+        yield from linhas
+
+
+def iterar_catalogo(conn, campos, filtros=None, filtros_campos=None, chunk_size=None):
+    """
+    Gera as linhas do catálogo lendo o cursor em blocos com fetchmany.
+    """
+    chunk_size = chunk_size or app.config['EXPORT_CHUNK_SIZE']
+    sql, parametros = consulta_produtos_pivotada(campos, COLUNAS_EXPORTACAO, filtros, filtros_campos)
+    yield from iterar_linhas(conn.execute(sql, parametros), chunk_size)
+
+
+def gerar_exportacao(formato, filtros=None, filtros_campos=None, usar_replica=False):
+    """
+    Gera o arquivo exportado em pedaços (bytes), com memória constante
+    independente do tamanho do catálogo. Usa uma conexão própria, fechada
+    ao final da exportação; com `usar_replica`, lê da réplica de relatórios
+    quando ela existir.
+
+    Os campos personalizados são identificados por campo_<id> (chaves do
+    JSONL), já que nomes podem se repetir ou coincidir com colunas de
+    products; no CSV e no XLSX o título é "<nome> (campo_<id>)".
+    """
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    conn = abrir_replica() if usar_replica else None
+    if conn is not None:
+        campos, linhas = iterar_catalogo_replica(conn, filtros, filtros_campos, chunk_size)
+    else:
+        campos = obter_campos_personalizados()
+        conn = abrir_conexao()
+        linhas = iterar_catalogo(conn, campos, filtros, filtros_campos, chunk_size)
+    chaves = list(COLUNAS_EXPORTACAO) + [f"campo_{campo[0]}" for campo in campos]
+    cabecalho = list(COLUNAS_EXPORTACAO) + [f"{campo[1]} (campo_{campo[0]})" for campo in campos]
+    try:
+
+        if formato == 'csv':
+            buffer = io.StringIO()
+            escritor = csv.writer(buffer)
+            escritor.writerow(cabecalho)
+            for numero, linha in enumerate(linhas, start=1):
+                escritor.writerow(linha)
+                if numero % chunk_size == 0:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue().encode('utf-8')
+
+        elif formato == 'jsonl':
+            bloco = []
+            for linha in linhas:
+                bloco.append(json.dumps(dict(zip(chaves, linha)), ensure_ascii=False))
+                if len(bloco) >= chunk_size:
+                    yield ('\n'.join(bloco) + '\n').encode('utf-8')
+                    bloco.clear()
+            if bloco:
+                yield ('\n'.join(bloco) + '\n').encode('utf-8')
+
+        elif formato == 'xlsx':
+            # O modo write_only grava as linhas direto no arquivo temporário;
+            # o XLSX só pode ser enviado depois de fechado (é um ZIP)
+            planilha = Workbook(write_only=True)
+            aba = planilha.create_sheet('Produtos')
+            aba.append(cabecalho)
+            for linha in linhas:
+                aba.append(linha)
+            with tempfile.TemporaryFile() as arquivo:
+                planilha.save(arquivo)
+                arquivo.seek(0)
+                for bloco in iter(lambda: arquivo.read(64 * 1024), b''):
+                    yield bloco
+    finally:
+        conn.close()
+
+
+def validar_formato_exportacao(formato):
+    """
+    Retorna uma mensagem de erro ou None se o formato puder ser gerado.
+    """
+    if formato not in FORMATOS_EXPORTACAO:
+        return f"Formato inválido. Use: {', '.join(FORMATOS_EXPORTACAO)}."
+    if formato == 'xlsx' and Workbook is None:
+        return "Exportação XLSX requer o pacote openpyxl."
+    return None
+
+
+@app.route('/exportar', methods=['GET'])
+def exportar():
+    """
+    Exporta o catálogo (com os mesmos filtros da listagem) em CSV, JSONL
+    ou XLSX, enviando a resposta em streaming. Com fonte=replica (ou
+    EXPORT_USAR_REPLICA) lê da réplica de relatórios, se ela for recente;
+    o cabeçalho X-Replica-Gerada-Em informa a data do snapshot usado.
+    """
+    formato = request.args.get('formato', 'csv').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return jsonify({'status': 'error', 'message': erro}), 400
+
+    try:
+        filtros, filtros_campos = ler_filtros_produtos(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Filtros inválidos.'}), 400
+
+    fonte = request.args.get('fonte') or ('replica' if app.config['EXPORT_USAR_REPLICA'] else 'principal')
+    cabecalhos = {'Content-Disposition': f'attachment; filename=catalogo.{formato}'}
+    gerada_em = replica_recente() if fonte == 'replica' else None
+    if gerada_em:
+        cabecalhos['X-Replica-Gerada-Em'] = gerada_em
+    return Response(
+        stream_with_context(gerar_exportacao(formato, filtros, filtros_campos, usar_replica=bool(gerada_em))),
+        mimetype=FORMATOS_EXPORTACAO[formato],
+        headers=cabecalhos
+    )
+
+
+@app.cli.command('exportar-catalogo')
+@click.option('--formato', type=click.Choice(list(FORMATOS_EXPORTACAO)), default='csv')
+@click.option('--saida', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Arquivo de destino (padrão: saída padrão).')
+def exportar_catalogo_command(formato, saida):
+    """
+    Exporta o catálogo completo em CSV, JSONL ou XLSX.
+    """
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        raise click.ClickException(erro)
+
+    init_db()
+    destino = open(saida, 'wb') if saida else click.get_binary_stream('stdout')
+    try:
+        for bloco in gerar_exportacao(formato):
+            destino.write(bloco)
+    finally:
+        if saida:
+            destino.close()
+
+
+# Grava (ou substitui) o valor de um campo personalizado em um produto
+SQL_ATRIBUIR_VALOR = """
+    INSERT INTO product_custom_field_values (produto_id, campo_id, valor_id)
+    VALUES (?, ?, ?)
+    ON CONFLICT (produto_id, campo_id) DO UPDATE SET valor_id = excluded.valor_id
+"""
 
 
 @app.route('/atualizar_valor', methods=['POST'])
@@ -415,42 +2253,17 @@ def atualizar_valor():
         campo_id = request.form.get('campo_id')
         valor_id = request.form.get('valor_id')
 
-        print(f"Recebido - Produto ID: {produto_id}, Campo ID: {campo_id}, Valor ID: {valor_id}")
-
         if not produto_id or not campo_id or not valor_id:
             flash("Erro: Todos os campos precisam ser preenchidos", "error")
             return redirect('/produtos')
 
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-
-            # Verifica se o registro já existe
-            cursor.execute("""
-                SELECT * FROM product_custom_field_values 
-                WHERE produto_id = ? AND campo_id = ?
-            """, (produto_id, campo_id))
-            existe = cursor.fetchone()
-
-            if existe:
-                # Atualiza o valor existente
-                cursor.execute("""
-                    UPDATE product_custom_field_values
-                    SET valor_id = ?
-                    WHERE produto_id = ? AND campo_id = ?
-                """, (valor_id, produto_id, campo_id))
-                flash("Valor atualizado com sucesso!", "success")
-            else:
-                # Insere um novo valor
-                cursor.execute("""
-                    INSERT INTO product_custom_field_values (produto_id, campo_id, valor_id)
-                    VALUES (?, ?, ?)
-                """, (produto_id, campo_id, valor_id))
-                flash("Valor salvo com sucesso!", "success")
-
+        with get_db() as conn:
+            conn.execute(SQL_ATRIBUIR_VALOR, (produto_id, campo_id, valor_id))
             conn.commit()
+        flash("Valor salvo com sucesso!", "success")
 
     except Exception as e:
-        print(f"Erro ao salvar o valor: {e}")
+        logger.error("Erro ao salvar o valor: %s", e)
         flash(f"Erro ao salvar o valor: {e}", "error")
 
     return redirect('/produtos')
@@ -459,62 +2272,715 @@ def atualizar_valor():
 def salvar_todos():
     try:
         data = request.get_json()
-        print("Dados recebidos no backend:", data)
-
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            for item in data['valores']:
-                produto_id = item.get('produto_id')
-                campo_id = item.get('campo_id')
-                valor_id = item.get('valor_id')
 
-                if produto_id and campo_id and valor_id:  # Validação dos dados
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO product_custom_field_values (produto_id, campo_id, valor_id)
-                        VALUES (?, ?, ?)
-                    """, (produto_id, campo_id, valor_id))
+        # Listas grandes podem ser gravadas em segundo plano
+        if data.get('assincrono'):
+            job_id = enfileirar_job('salvar_valores', {'valores': data['valores']})
+            return jsonify({'status': 'success', 'job_id': job_id,
+                            'url': url_for('status_job', job_id=job_id)}), 202
+
+        # Apenas itens completos, enviados ao banco em um único executemany
+        # a partir de um gerador (sem uma segunda lista do tamanho do JSON)
+        linhas = (
+            (item.get('produto_id'), item.get('campo_id'), item.get('valor_id'))
+            for item in data['valores']
+            if item.get('produto_id') and item.get('campo_id') and item.get('valor_id')
+        )
 
+        with get_db() as conn:
+            conn.executemany(SQL_ATRIBUIR_VALOR, linhas)
             conn.commit()
         return jsonify({'status': 'success', 'message': 'Valores salvos com sucesso!'})
     except Exception as e:
-        print("Erro ao salvar os valores:", e)
+        logger.error("Erro ao salvar os valores: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
-@app.route('/salvar_tabela_produtos', methods=['POST'])
-def salvar_tabela_produtos():
+@app.route('/atribuir_valor_em_massa', methods=['POST'])
+def atribuir_valor_em_massa():
+    """
+    Aplica um valor de campo personalizado a vários produtos em um único
+    comando SQL. Recebe JSON com campo_id, valor_id e 'produto_ids' (lista)
+    ou 'filtros' (mesmo formato da listagem, ex.: {"categoria": "Tênis"}).
+    """
     try:
-        data = request.json  # Captura os dados enviados pelo frontend
-        produtos = data.get('produtos', [])
+        data = request.get_json() or {}
+        campo_id = int(data.get('campo_id') or 0)
+        valor_id = int(data.get('valor_id') or 0)
+        produto_ids = [int(produto_id) for produto_id in data.get('produto_ids') or []]
+        filtros, filtros_campos = ler_filtros_produtos(data.get('filtros') or {})
+    except (TypeError, ValueError, AttributeError):
+        return jsonify({'status': 'error', 'message': 'Parâmetros inválidos.'}), 400
+
+    if not campo_id or not valor_id:
+        return jsonify({'status': 'error', 'message': 'Informe campo_id e valor_id.'}), 400
+    if not produto_ids and not filtros and not filtros_campos:
+        return jsonify({'status': 'error', 'message': 'Informe produto_ids ou ao menos um filtro.'}), 400
 
-        with sqlite3.connect(DB_NAME) as conn:
+    try:
+        with get_db() as conn:
             cursor = conn.cursor()
-
-            for produto in produtos:
-                produto_id = produto.get('produto_id')
-                nome_comercial = produto.get('nome_comercial', '').strip()
-
-                # Atualiza o banco de dados apenas se houver um nome_comercial válido
-                if nome_comercial:
-                    cursor.execute("""
-                        UPDATE products 
-                        SET nome_comercial = ?
-                        WHERE id = ?
-                    """, (nome_comercial, produto_id))
-            
+            cursor.execute("SELECT 1 FROM custom_values WHERE id = ? AND campo_id = ?", (valor_id, campo_id))
+            if not cursor.fetchone():
+                return jsonify({'status': 'error', 'message': 'Valor não pertence ao campo informado.'}), 400
+
+            if produto_ids:
+                # A lista vai como um único parâmetro JSON, sem limite de variáveis do SQLite
+                condicoes = ["id IN (SELECT value FROM json_each(?))"]
+                parametros = [json.dumps(produto_ids)]
+            else:
+                condicoes, parametros = montar_filtros_produtos(filtros, filtros_campos)
+
+            cursor.execute(f"""
+                INSERT INTO product_custom_field_values (produto_id, campo_id, valor_id)
+                SELECT id, ?, ? FROM products
+                WHERE {' AND '.join(condicoes)}
+                ON CONFLICT (produto_id, campo_id) DO UPDATE SET valor_id = excluded.valor_id
+            """, [campo_id, valor_id] + parametros)
+            afetados = cursor.rowcount
             conn.commit()
 
         return jsonify({
-            "status": "success",
-            "message": f"{len(produtos)} produtos atualizados com sucesso!"
+            'status': 'success',
+            'message': f"Valor aplicado a {afetados} produtos.",
+            'afetados': afetados
         })
-    except Exception as e:
-        print(f"Erro ao salvar os dados da tabela: {e}")
+    except sqlite3.Error as e:
+        logger.error("Erro na atribuição em massa: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+def ler_alteracoes_grade(alteracoes):
+    """
+    Agrupa as alterações [{produto_id, versao, campo, valor}] por produto:
+    {produto_id: (versao, {campo: valor})}. Lança ValueError para campos
+    não editáveis ou ids/versões inválidos.
+    """
+    produtos = {}
+    for alteracao in alteracoes:
+        campo = alteracao.get('campo')
+        if campo not in CAMPOS_EDITAVEIS:
+            raise ValueError(f"Campo não editável: {campo}")
+        produto_id = int(alteracao['produto_id'])
+        versao = int(alteracao['versao'])
+        valor = alteracao.get('valor')
+        if valor is not None:
+            valor = str(valor).strip() or None
+        produtos.setdefault(produto_id, (versao, {}))[1][campo] = valor
+    return produtos
+
+
+def buscar_linhas_produtos(conn, produto_ids):
+    """
+    Linhas atuais (colunas da listagem) dos produtos informados.
+    """
+    cursor = conn.execute(f"""
+        SELECT {', '.join(COLUNAS_LISTAGEM)}
+        FROM products
+        WHERE id IN (SELECT value FROM json_each(?))
+    """, (json.dumps(list(produto_ids)),))
+    return [dict(zip(COLUNAS_LISTAGEM, linha)) for linha in cursor]
+
+
+@app.route('/salvar_tabela_produtos', methods=['POST'])
+def salvar_tabela_produtos():
+    """
+    Grava apenas as células alteradas na grade. Recebe JSON com
+    'alteracoes': [{produto_id, versao, campo, valor}]. Produtos cuja versão
+    mudou desde a leitura são rejeitados; os demais são gravados em uma
+    única transação. Retorna as linhas atualizadas e as rejeitadas (com os
+    dados atuais) para a página se corrigir sem recarregar.
+    """
+    try:
+        data = request.get_json() or {}
+        produtos = ler_alteracoes_grade(data.get('alteracoes', []))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f"Alterações inválidas: {e}"}), 400
+
+    if not produtos:
+        return jsonify({'status': 'success', 'message': 'Nenhuma alteração para salvar.',
+                        'produtos': [], 'conflitos': []})
+
+    try:
+        with get_db() as conn:
+            # Lock de escrita desde a leitura das versões até o commit
+            conn.execute("BEGIN IMMEDIATE")
+            atuais = dict(conn.execute(
+                "SELECT id, versao FROM products WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(produtos)),)
+            ).fetchall())
+
+            # Um executemany por conjunto de colunas alteradas
+            lotes = {}
+            conflitos = []
+            for produto_id, (versao, campos) in produtos.items():
+                if atuais.get(produto_id) != versao:
+                    conflitos.append(produto_id)
+                    continue
+                colunas = tuple(sorted(campos))
+                lotes.setdefault(colunas, []).append(
+                    [campos[coluna] for coluna in colunas] + [produto_id, versao]
+                )
+
+            for colunas, linhas in lotes.items():
+                atribuicoes = ', '.join(f"{coluna} = ?" for coluna in colunas)
+                conn.executemany(f"""
+                    UPDATE products
+                    SET {atribuicoes}, versao = versao + 1
+                    WHERE id = ? AND versao = ?
+                """, linhas)
+
+            gravados = [produto_id for produto_id in produtos if produto_id not in conflitos]
+            linhas_gravadas = buscar_linhas_produtos(conn, gravados)
+            linhas_conflito = buscar_linhas_produtos(conn, conflitos)
+    except sqlite3.Error as e:
+        logger.error("Erro ao salvar os dados da tabela: %s", e)
         return jsonify({
             "status": "error",
             "message": "Erro ao salvar os dados da tabela."
         }), 500
 
+    mensagem = f"{len(gravados)} produtos atualizados com sucesso!"
+    if conflitos:
+        mensagem += (f" {len(conflitos)} produtos foram alterados por outra pessoa"
+                     " e não foram salvos; os valores atuais foram carregados.")
+    return jsonify({
+        "status": "success" if not conflitos else "partial",
+        "message": mensagem,
+        "produtos": linhas_gravadas,
+        "conflitos": linhas_conflito
+    }), 200 if gravados or not conflitos else 409
+
+
+# Fila de jobs em segundo plano (importações e recálculos longos).
+# Os jobs ficam na tabela 'jobs' e rodam num pool de threads do próprio
+# processo; as rotas apenas enfileiram e o navegador consulta o progresso.
+from concurrent.futures import ThreadPoolExecutor
+
+app.config['JOBS_WORKERS'] = 2
+app.config['JOBS_CHUNK_SIZE'] = 5000
+
+_jobs_executor = None
+_jobs_lock = threading.Lock()
+# Pedidos de cancelamento também ficam em memória: o job os enxerga mesmo
+# que o UPDATE da rota ainda esteja esperando o lock de escrita.
+_jobs_cancelados = set()
+
+
+class JobCancelado(Exception):
+    pass
+
+
+def atualizar_progresso(job_id, processados, total=None):
+    """
+    Grava o progresso do job (confirmando o trabalho feito até aqui) e
+    interrompe a execução com JobCancelado se o cancelamento foi pedido.
+    """
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET processados = ?, total = COALESCE(?, total) WHERE id = ?",
+            (processados, total, job_id)
+        )
+        conn.commit()
+        cancelar = conn.execute("SELECT cancelar FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+    if cancelar or job_id in _jobs_cancelados:
+        raise JobCancelado()
+
+
+def job_nome_comercial(job_id, parametros):
+    """
+    Recalcula o nome comercial em faixas de id, confirmando cada faixa.
+    Só os produtos cujo nome muda são gravados (e têm a versão incrementada).
+    """
+    incremental = parametros.get('modo') == 'incremental'
+    filtro = "AND nome_comercial_pendente = 1" if incremental else ""
+    passo = app.config['JOBS_CHUNK_SIZE']
+
+    conn = get_db()
+    minimo, maximo, total = conn.execute(
+        f"SELECT MIN(id), MAX(id), COUNT(*) FROM products WHERE 1 = 1 {filtro}"
+    ).fetchone()
+    atualizar_progresso(job_id, 0, total)
+    if not total:
+        return {'atualizados': 0}
+
+    atualizados = processados = 0
+    for inicio in range(minimo, maximo + 1, passo):
+        faixa = (inicio, inicio + passo - 1)
+        with conn:
+            processados += conn.execute(
+                f"SELECT COUNT(*) FROM products WHERE id BETWEEN ? AND ? {filtro}", faixa
+            ).fetchone()[0]
+            cursor = conn.execute(f"""
+                UPDATE products
+                SET nome_comercial = {SQL_NOME_COMERCIAL},
+                    versao = versao + 1
+                WHERE id BETWEEN ? AND ? AND nome_comercial IS NOT ({SQL_NOME_COMERCIAL}) {filtro}
+            """, faixa)
+            atualizados += cursor.rowcount
+            conn.execute("""
+                UPDATE products SET nome_comercial_pendente = 0
+                WHERE id BETWEEN ? AND ? AND nome_comercial_pendente = 1
+            """, faixa)
+        atualizar_progresso(job_id, processados)
+    return {'atualizados': atualizados}
+
+
+def caminho_em_uploads(caminho):
+    """
+    Indica se o caminho (resolvidos os links) fica dentro de UPLOAD_FOLDER.
+    """
+    pasta = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    return os.path.commonpath([pasta, os.path.realpath(caminho)]) == pasta
+
+
+def job_importar_xml(job_id, parametros):
+    """
+    Importa os XMLs já salvos em UPLOAD_FOLDER, com o progresso em itens
+    gravados. Caminhos fora da pasta de uploads são recusados.
+    """
+    caminhos = [caminho for caminho in parametros.get('arquivos', []) if caminho_em_uploads(caminho)]
+    recusados = [
+        {'arquivo': os.path.basename(caminho), 'status': 'error',
+         'message': 'Arquivo fora da pasta de uploads.'}
+        for caminho in parametros.get('arquivos', []) if not caminho_em_uploads(caminho)
+    ]
+    resultados = importar_arquivos(
+        caminhos, progresso=lambda gravados, total: atualizar_progresso(job_id, gravados, total)
+    )
+    return {'resultados': recusados + resultados}
+
+
+def job_salvar_valores(job_id, parametros):
+    """
+    Mesmo efeito de /salvar_todos, gravado em blocos com progresso.
+    """
+    linhas = [
+        (item.get('produto_id'), item.get('campo_id'), item.get('valor_id'))
+        for item in parametros.get('valores', [])
+        if item.get('produto_id') and item.get('campo_id') and item.get('valor_id')
+    ]
+    atualizar_progresso(job_id, 0, len(linhas))
+    passo = app.config['JOBS_CHUNK_SIZE']
+    conn = get_db()
+    for inicio in range(0, len(linhas), passo):
+        with conn:
+            conn.executemany(SQL_ATRIBUIR_VALOR, linhas[inicio:inicio + passo])
+        atualizar_progresso(job_id, min(inicio + passo, len(linhas)))
+    return {'gravados': len(linhas)}
+
+
+TIPOS_JOB = {
+    'nome_comercial': job_nome_comercial,
+    'importar_xml': job_importar_xml,
+    'salvar_valores': job_salvar_valores,
+}
+
+# Tipos que podem ser enfileirados direto por POST /jobs; a importação só
+# é enfileirada pelas rotas de upload, que definem os arquivos
+TIPOS_JOB_PUBLICOS = {'nome_comercial', 'salvar_valores'}
+
+
+def executar_job(job_id):
+    conn = get_db()
+    with conn:
+        # Reserva o job num único UPDATE: se outro processo já o pegou,
+        # nenhuma linha é alterada
+        cursor = conn.execute("""
+            UPDATE jobs
+            SET status = CASE WHEN cancelar THEN 'cancelado' ELSE 'executando' END,
+                iniciado_em = ?
+            WHERE id = ? AND status = 'pendente'
+        """, (time.time(), job_id))
+        if not cursor.rowcount:
+            return
+        tipo, parametros, status = conn.execute(
+            "SELECT tipo, parametros, status FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    if status == 'cancelado':
+        return
+
+    logger.info("Job %s (%s) iniciado.", job_id, tipo)
+    try:
+        resultado = TIPOS_JOB[tipo](job_id, json.loads(parametros or '{}'))
+        status, erro = 'concluido', None
+    except JobCancelado:
+        resultado, status, erro = None, 'cancelado', None
+    except Exception as e:
+        logger.exception("Erro no job %s (%s).", job_id, tipo)
+        resultado, status, erro = None, 'erro', str(e)
+
+    if conn.in_transaction:
+        conn.rollback()
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, resultado = ?, erro = ?, finalizado_em = ? WHERE id = ?",
+            (status, json.dumps(resultado, ensure_ascii=False) if resultado is not None else None,
+             erro, time.time(), job_id)
+        )
+    _jobs_cancelados.discard(job_id)
+    logger.info("Job %s (%s) finalizado: %s.", job_id, tipo, status)
+
+
+def obter_executor_jobs():
+    """
+    Cria o pool na primeira chamada e envia a ele os jobs pendentes (a
+    reserva em executar_job impede que dois processos rodem o mesmo job).
+    """
+    global _jobs_executor
+    with _jobs_lock:
+        if _jobs_executor is None:
+            _jobs_executor = ThreadPoolExecutor(
+                max_workers=app.config['JOBS_WORKERS'], thread_name_prefix='job'
+            )
+            pendentes = [linha[0] for linha in get_db().execute(
+                "SELECT id FROM jobs WHERE status = 'pendente' ORDER BY id")]
+            for job_id in pendentes:
+                _jobs_executor.submit(executar_job, job_id)
+        return _jobs_executor
+
+
+def recuperar_jobs_interrompidos():
+    """
+    Marca como erro os jobs que ficaram 'executando' após uma parada do
+    servidor. Deve rodar apenas na inicialização (ou pelo comando
+    recuperar-jobs), quando nenhum worker está executando jobs.
+    """
+    with get_db() as conn:
+        cursor = conn.execute("""
+            UPDATE jobs SET status = 'erro', erro = 'Interrompido pela parada do servidor.',
+                finalizado_em = ?
+            WHERE status = 'executando'
+        """, (time.time(),))
+    if cursor.rowcount:
+        logger.warning("%s jobs interrompidos marcados como erro.", cursor.rowcount)
+    return cursor.rowcount
+
+
+@app.cli.command('recuperar-jobs')
+def recuperar_jobs_command():
+    """
+    Marca como erro os jobs interrompidos (com os servidores parados).
+    """
+    init_db()
+    click.echo(f"{recuperar_jobs_interrompidos()} jobs marcados como erro.")
+
+
+def enfileirar_job(tipo, parametros):
+    """
+    Registra o job e o envia ao pool. Retorna o id do job.
+    """
+    if tipo not in TIPOS_JOB:
+        raise ValueError(f"Tipo de job desconhecido: {tipo}")
+    executor = obter_executor_jobs()
+    with get_db() as conn:
+        cursor = conn.execute(
+            "INSERT INTO jobs (tipo, parametros) VALUES (?, ?)",
+            (tipo, json.dumps(parametros, ensure_ascii=False))
+        )
+        job_id = cursor.lastrowid
+    executor.submit(executar_job, job_id)
+    return job_id
+
+
+def descrever_job(linha):
+    job_id, tipo, status, processados, total, resultado, erro, criado_em, iniciado_em, finalizado_em = linha
+    eta = None
+    if status == 'executando' and iniciado_em and processados and total:
+        decorrido = time.time() - iniciado_em
+        eta = round(decorrido / processados * (total - processados), 1)
+    return {
+        'id': job_id,
+        'tipo': tipo,
+        'status': status,
+        'processados': processados,
+        'total': total,
+        'percentual': round(processados * 100 / total, 1) if total else None,
+        'eta_segundos': eta,
+        'resultado': json.loads(resultado) if resultado else None,
+        'erro': erro,
+        'criado_em': criado_em,
+        'duracao_segundos': round((finalizado_em or time.time()) - iniciado_em, 1) if iniciado_em else None,
+    }
+
+
+SQL_DESCREVER_JOB = """
+    SELECT id, tipo, status, processados, total, resultado, erro, criado_em, iniciado_em, finalizado_em
+    FROM jobs
+"""
+
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def jobs():
+    """
+    GET lista os jobs recentes; POST enfileira um job ({tipo, parametros}).
+    """
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        if data.get('tipo') not in TIPOS_JOB_PUBLICOS:
+            return jsonify({'status': 'error', 'message': f"Tipo de job não permitido: {data.get('tipo')}"}), 400
+        try:
+            job_id = enfileirar_job(data.get('tipo'), data.get('parametros') or {})
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        return jsonify({'status': 'success', 'job_id': job_id,
+                        'url': url_for('status_job', job_id=job_id)}), 202
+
+    linhas = get_db().execute(SQL_DESCREVER_JOB + " ORDER BY id DESC LIMIT 50").fetchall()
+    return jsonify({'status': 'success', 'jobs': [descrever_job(linha) for linha in linhas]})
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def status_job(job_id):
+    linha = get_db().execute(SQL_DESCREVER_JOB + " WHERE id = ?", (job_id,)).fetchone()
+    if not linha:
+        return jsonify({'status': 'error', 'message': 'Job não encontrado.'}), 404
+    return jsonify({'status': 'success', 'job': descrever_job(linha)})
+
+
+@app.route('/jobs/<int:job_id>/cancelar', methods=['POST'])
+def cancelar_job(job_id):
+    """
+    Pede o cancelamento; o job para no próximo registro de progresso.
+    """
+    _jobs_cancelados.add(job_id)
+    with get_db() as conn:
+        cursor = conn.execute("""
+            UPDATE jobs SET cancelar = 1,
+                status = CASE WHEN status = 'pendente' THEN 'cancelado' ELSE status END
+            WHERE id = ? AND status IN ('pendente', 'executando')
+        """, (job_id,))
+        # O job pode ter parado pelo pedido em memória antes deste UPDATE
+        cancelado = cursor.rowcount or conn.execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND status = 'cancelado'", (job_id,)
+        ).fetchone()
+    if not cancelado:
+        _jobs_cancelados.discard(job_id)
+        return jsonify({'status': 'error', 'message': 'Job não encontrado ou já finalizado.'}), 404
+    return jsonify({'status': 'success', 'message': 'Cancelamento solicitado.'})
+
+
+from datetime import datetime, timedelta, timezone
+
+# Réplica de relatórios: cópia do banco feita com a API de backup online do
+# SQLite, acrescida da tabela desnormalizada 'catalogo' (produtos com um
+# campo_<id> por campo personalizado). Leituras pesadas (exportação,
+# relatórios) vão para ela e não disputam o arquivo principal com a edição.
+app.config['REPLICA_DATABASE'] = os.path.join(BASE_DIR, 'database/relatorios.db')
+app.config['REPLICA_INTERVALO_MINUTOS'] = int(os.environ.get('REPLICA_INTERVALO_MINUTOS', 0))
+# -1 copia tudo num passo: no modo WAL a leitura não bloqueia quem escreve,
+# e a cópia não recomeça a cada escrita feita durante o backup
+app.config['REPLICA_PAGINAS_POR_PASSO'] = -1
+# A exportação só lê da réplica quando pedida (fonte=replica) ou quando
+# EXPORT_USAR_REPLICA estiver ligado, e apenas se a réplica for recente
+app.config['EXPORT_USAR_REPLICA'] = False
+app.config['REPLICA_IDADE_MAXIMA_MINUTOS'] = 60
+
+INDICES_REPLICA = ('codigo', 'ean', 'categoria', 'marca', 'modelo', 'cor', 'faixa_etaria', 'genero')
+
+_agendador_replica = None
+
+
+def abrir_replica():
+    """
+    Conexão somente leitura com a réplica de relatórios, ou None se ela
+    ainda não foi gerada.
+    """
+    caminho = app.config['REPLICA_DATABASE']
+    if not os.path.exists(caminho):
+        return None
+    conn = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    return conn
+
+
+def replica_recente():
+    """
+    Data de geração (UTC, texto de replica_info) da réplica, se ela existir
+    e tiver no máximo REPLICA_IDADE_MAXIMA_MINUTOS; senão None.
+    """
+    conn = abrir_replica()
+    if conn is None:
+        return None
+    try:
+        gerada_em = conn.execute("SELECT gerada_em FROM replica_info").fetchone()[0]
+    finally:
+        conn.close()
+    idade = datetime.now(timezone.utc) - datetime.strptime(gerada_em, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    if idade > timedelta(minutes=app.config['REPLICA_IDADE_MAXIMA_MINUTOS']):
+        return None
+    return gerada_em
+
+
+def desnormalizar_replica(conn):
+    """
+    Cria na cópia a tabela 'catalogo' (produtos com os valores
+    personalizados pivotados em colunas), 'catalogo_campos' (coluna ->
+    nome do campo), os índices dos relatórios e 'replica_info'.
+    """
+    campos = conn.execute("SELECT id, nome FROM custom_fields ORDER BY id").fetchall()
+    colunas_campos = [f"campo_{campo_id}" for campo_id, _ in campos]
+
+    definicao = (['id INTEGER PRIMARY KEY']
+                 + [f"{nome} {tipo}" for nome, tipo in COLUNAS_PRODUCTS]
+                 + [f"{coluna} TEXT" for coluna in colunas_campos])
+    conn.execute(f"CREATE TABLE catalogo ({', '.join(definicao)})")
+    sql, parametros = consulta_produtos_pivotada(campos, COLUNAS_EXPORTACAO)
+    conn.execute(f"INSERT INTO catalogo SELECT * FROM ({sql})", parametros)
+    for coluna in INDICES_REPLICA + tuple(colunas_campos):
+        conn.execute(f"CREATE INDEX idx_catalogo_{coluna} ON catalogo({coluna})")
+
+    conn.execute("CREATE TABLE catalogo_campos (coluna TEXT PRIMARY KEY, campo_id INTEGER, nome TEXT)")
+    conn.executemany(
+        "INSERT INTO catalogo_campos (coluna, campo_id, nome) VALUES (?, ?, ?)",
+        [(coluna, campo_id, nome) for coluna, (campo_id, nome) in zip(colunas_campos, campos)]
+    )
+
+    conn.execute("CREATE TABLE replica_info (gerada_em TEXT, produtos INTEGER, versao_esquema INTEGER)")
+    conn.execute("""
+        INSERT INTO replica_info
+        SELECT CURRENT_TIMESTAMP, (SELECT COUNT(*) FROM catalogo), (SELECT user_version FROM pragma_user_version)
+    """)
+    conn.execute("ANALYZE")
+
+
+def gerar_replica(destino=None, progresso=None):
+    """
+    Copia o banco principal com a API de backup online, desnormaliza a
+    cópia e a publica em `destino` (padrão: REPLICA_DATABASE) trocando o
+    arquivo de uma vez; quem já está lendo a réplica anterior não é
+    afetado. `progresso(copiadas, total)` recebe as páginas copiadas.
+    Retorna as informações da réplica gerada.
+    """
+    destino = destino or app.config['REPLICA_DATABASE']
+    temporario = destino + '.tmp'
+    if os.path.exists(temporario):
+        os.remove(temporario)
+
+    inicio = time.perf_counter()
+    origem = abrir_conexao()
+    copia = sqlite3.connect(temporario)
+    try:
+        def informar(status, restantes, total):
+            if progresso:
+                progresso(total - restantes, total)
+
+        origem.backup(copia, pages=app.config['REPLICA_PAGINAS_POR_PASSO'], progress=informar, sleep=0.01)
+        copia.execute("PRAGMA journal_mode = DELETE")
+        with copia:
+            desnormalizar_replica(copia)
+        gerada_em, produtos, _ = copia.execute("SELECT * FROM replica_info").fetchone()
+        copia.close()
+        os.replace(temporario, destino)
+    except BaseException:
+        copia.close()
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+    finally:
+        origem.close()
+
+    informacoes = {
+        'gerada_em': gerada_em,
+        'produtos': produtos,
+        'tamanho_mb': round(os.path.getsize(destino) / (1024 * 1024), 1),
+        'segundos': round(time.perf_counter() - inicio, 2),
+    }
+    logger.info("Réplica de relatórios gerada: %s", informacoes)
+    return informacoes
+
+
+def iterar_catalogo_replica(conn, filtros=None, filtros_campos=None, chunk_size=None):
+    """
+    Retorna (campos, linhas) do catálogo lido da tabela desnormalizada
+    da réplica, com os mesmos filtros da listagem; campos é a lista
+    [(campo_id, nome)] das colunas personalizadas, na ordem das linhas.
+    """
+    chunk_size = chunk_size or app.config['EXPORT_CHUNK_SIZE']
+    colunas = conn.execute("SELECT coluna, campo_id, nome FROM catalogo_campos ORDER BY campo_id").fetchall()
+
+    condicoes, parametros = montar_filtros_produtos(filtros, filtros_campos, tabela='p')
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    selecao = [f"p.{coluna}" for coluna in COLUNAS_EXPORTACAO] + [f"p.{coluna}" for coluna, _, _ in colunas]
+    cursor = conn.execute(f"""
+        SELECT {', '.join(selecao)}
+        FROM catalogo p
+        {where}
+        ORDER BY p.id
+    """, parametros)
+    return [(campo_id, nome) for _, campo_id, nome in colunas], iterar_linhas(cursor, chunk_size)
+
+
+def job_gerar_replica(job_id, parametros):
+    return gerar_replica(progresso=lambda copiadas, total: atualizar_progresso(job_id, copiadas, total))
+
+
+TIPOS_JOB['replica'] = job_gerar_replica
+
+
+def iniciar_agendamento_replica():
+    """
+    Enfileira a geração da réplica agora e a cada REPLICA_INTERVALO_MINUTOS
+    (0 desliga), sem acumular jobs se o anterior ainda não terminou.
+    """
+    global _agendador_replica
+    intervalo = app.config['REPLICA_INTERVALO_MINUTOS']
+    if not intervalo or _agendador_replica is not None:
+        return
+
+    def agendar():
+        while True:
+            try:
+                em_andamento = get_db().execute(
+                    "SELECT 1 FROM jobs WHERE tipo = 'replica' AND status IN ('pendente', 'executando')"
+                ).fetchone()
+                if not em_andamento:
+                    enfileirar_job('replica', {})
+            except Exception as e:
+                logger.error("Erro ao agendar a réplica de relatórios: %s", e)
+            time.sleep(intervalo * 60)
+
+    _agendador_replica = threading.Thread(target=agendar, name='agendador-replica', daemon=True)
+    _agendador_replica.start()
+
+
+@app.route('/replica', methods=['GET', 'POST'])
+def replica():
+    """
+    GET informa a réplica atual; POST enfileira uma nova geração.
+    """
+    if request.method == 'POST':
+        job_id = enfileirar_job('replica', {})
+        return jsonify({'status': 'success', 'job_id': job_id,
+                        'url': url_for('status_job', job_id=job_id)}), 202
+
+    conn = abrir_replica()
+    if conn is None:
+        return jsonify({'status': 'error', 'message': 'Réplica ainda não gerada.'}), 404
+    try:
+        gerada_em, produtos, versao_esquema = conn.execute("SELECT * FROM replica_info").fetchone()
+    finally:
+        conn.close()
+    return jsonify({'status': 'success', 'replica': {
+        'gerada_em': gerada_em,
+        'produtos': produtos,
+        'versao_esquema': versao_esquema,
+        'tamanho_mb': round(os.path.getsize(app.config['REPLICA_DATABASE']) / (1024 * 1024), 1),
+    }})
+
+
+@app.cli.command('gerar-replica')
+def gerar_replica_command():
+    """
+    Gera a réplica de relatórios (para uso em cron).
+    """
+    init_db()
+    informacoes = gerar_replica()
+    click.echo(f"Réplica gerada: {informacoes['produtos']} produtos, "
+               f"{informacoes['tamanho_mb']} MB em {informacoes['segundos']}s.")
+
+
 # Rotas anteriores (custom_fields, produtos, etc.)
 
 @app.route('/')
@@ -526,13 +2992,15 @@ def index():
 
 if __name__ == '__main__':
     init_db()  # Inicializa o banco de dados
+    recuperar_jobs_interrompidos()
+    obter_executor_jobs()  # Retoma os jobs que ficaram pendentes
+    iniciar_agendamento_replica()
     app.run(debug=True)
 
 
 
 # Imprimir todas as rotas registradas
-print("Rotas registradas no Flask:")
-print(app.url_map)
+logger.debug("Rotas registradas no Flask:\n%s", app.url_map)
 
 # Inicializa o servidor Flask
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+"""
+Entrada ASGI da aplicação.
+
+O recebimento de NF-e (POST /api/nfe) é tratado aqui de forma assíncrona:
+o corpo é gravado em disco à medida que chega, sem ocupar uma thread por
+conexão, e a importação é enfileirada na fila de jobs do app Flask (mesma
+importação de importar_arquivos). As demais rotas são repassadas ao app
+Flask via asgiref, se estiver instalado.
+
+Uso:
+    flask recuperar-jobs   # antes de subir os workers, após uma parada
+    uvicorn asgi:application
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+from urllib.parse import parse_qs
+
+from app import (app, init_db, iniciar_agendamento_replica, nome_arquivo_nfe, destino_nfe, enfileirar_job,
+                 obter_executor_jobs)
+
+try:
+    from asgiref.wsgi import WsgiToAsgi  # Opcional, para as demais rotas
+except ImportError:
+    WsgiToAsgi = None
+
+logger = logging.getLogger('produtos')
+
+CAMINHO_NFE = '/api/nfe'
+
+flask_asgi = WsgiToAsgi(app) if WsgiToAsgi else None
+
+
+async def responder(send, status, corpo):
+    conteudo = json.dumps(corpo, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json; charset=utf-8'),
+            (b'content-length', str(len(conteudo)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': conteudo})
+
+
+async def receber_nfe(scope, receive, send):
+    """
+    Versão assíncrona de app.receber_nfe: escrita em disco e gravação do
+    job rodam no executor padrão do loop.
+    """
+    loop = asyncio.get_running_loop()
+    parametros = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        nome = nome_arquivo_nfe(parametros.get('nome', [None])[0])
+    except ValueError as e:
+        await responder(send, 400, {'status': 'error', 'message': str(e)})
+        return
+
+    limite = app.config['NFE_MAX_BYTES']
+    destino = await loop.run_in_executor(None, destino_nfe, nome)
+    saida = await loop.run_in_executor(None, open, destino, 'wb')
+    recebidos = 0
+    try:
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'http.disconnect':
+                recebidos = None
+                break
+            bloco = mensagem.get('body', b'')
+            recebidos += len(bloco)
+            if recebidos > limite:
+                break
+            if bloco:
+                await loop.run_in_executor(None, saida.write, bloco)
+            if not mensagem.get('more_body'):
+                break
+    finally:
+        await loop.run_in_executor(None, saida.close)
+
+    if not recebidos or recebidos > limite:
+        await loop.run_in_executor(None, shutil.rmtree, os.path.dirname(destino), True)
+        if recebidos is None:
+            logger.warning("Conexão encerrada durante o envio de %s.", nome)
+        elif recebidos:
+            await responder(send, 413, {'status': 'error', 'message': 'Arquivo maior que o permitido.'})
+        else:
+            await responder(send, 400, {'status': 'error', 'message': 'Nenhum conteúdo enviado.'})
+        return
+
+    job_id = await loop.run_in_executor(None, enfileirar_job, 'importar_xml', {'arquivos': [destino]})
+    await responder(send, 202, {'status': 'success', 'job_id': job_id, 'url': f"/jobs/{job_id}"})
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(None, init_db)
+                # Retoma os jobs pendentes (ex.: NF-e enfileiradas antes de reiniciar)
+                await asyncio.get_running_loop().run_in_executor(None, obter_executor_jobs)
+                iniciar_agendamento_replica()
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['path'] == CAMINHO_NFE and scope['method'] == 'POST':
+        await receber_nfe(scope, receive, send)
+    elif flask_asgi is not None:
+        await flask_asgi(scope, receive, send)
+    else:
+        await responder(send, 404, {
+            'status': 'error',
+            'message': 'Rota disponível apenas no servidor WSGI (instale asgiref para servi-la aqui).'
+        })
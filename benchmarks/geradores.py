@@ -0,0 +1,100 @@
+"""
+Geradores de dados sintéticos para os benchmarks: arquivos NF-e (XML) e um
+catálogo com campos/valores personalizados gravado direto no SQLite.
+"""
+import random
+from xml.sax.saxutils import escape
+
+NFE_XMLNS = 'http://www.portalfiscal.inf.br/nfe'
+
+CATEGORIAS = ['Tênis', 'Camiseta', 'Bermuda', 'Meia', 'Boné', 'Jaqueta']
+MARCAS = ['Asics', 'Nike', 'Adidas', 'Puma', 'Mizuno', 'Olympikus']
+CORES = ['Azul', 'Preto', 'Branco', 'Vermelho', 'Verde', 'Cinza']
+FAIXAS_ETARIAS = ['Infantil', 'Juvenil', 'Adulto']
+GENEROS = ['Masculino', 'Feminino', 'Unissex']
+
+
+def gerar_nfe(caminho, itens, proporcao_ipi=0.5, seed=0, prefixo='P'):
+    """
+    Grava em `caminho` uma NF-e com `itens` produtos. Uma fração
+    `proporcao_ipi` dos itens recebe o grupo IPITrib. O arquivo é escrito
+    item a item, sem montar o XML inteiro em memória.
+    """
+    rnd = random.Random(seed)
+    with open(caminho, 'w', encoding='utf-8') as arquivo:
+        arquivo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        arquivo.write(f'<nfeProc xmlns="{NFE_XMLNS}" versao="4.00"><NFe><infNFe Id="NFe{seed:044d}" versao="4.00">')
+        arquivo.write('<ide><cUF>35</cUF><natOp>VENDA</natOp><mod>55</mod><serie>1</serie>'
+                      f'<nNF>{seed + 1}</nNF></ide>')
+        arquivo.write('<emit><CNPJ>00000000000191</CNPJ><xNome>Fornecedor Sintético</xNome></emit>')
+        arquivo.write('<dest><CNPJ>00000000000272</CNPJ><xNome>Loja Sintética</xNome></dest>')
+
+        for numero in range(1, itens + 1):
+            quantidade = rnd.randint(1, 50)
+            preco = round(rnd.uniform(5, 500), 2)
+            total = round(quantidade * preco, 2)
+            icms = round(total * 0.18, 2)
+            descricao = escape(f"{rnd.choice(CATEGORIAS)} {rnd.choice(MARCAS)} {rnd.choice(CORES)} {numero}")
+
+            ipi = ''
+            if rnd.random() < proporcao_ipi:
+                ipi = ('<IPI><cEnq>999</cEnq><IPITrib><CST>50</CST>'
+                       f'<vBC>{total:.2f}</vBC><pIPI>5.00</pIPI><vIPI>{total * 0.05:.2f}</vIPI>'
+                       '</IPITrib></IPI>')
+
+            arquivo.write(
+                f'<det nItem="{numero}"><prod>'
+                f'<cProd>{prefixo}{numero:07d}</cProd><cEAN>{7890000000000 + numero}</cEAN>'
+                f'<xProd>{descricao}</xProd><NCM>64041100</NCM><CFOP>6102</CFOP><uCom>PAR</uCom>'
+                f'<qCom>{quantidade:.4f}</qCom><vUnCom>{preco:.10f}</vUnCom><vProd>{total:.2f}</vProd>'
+                '</prod><imposto>'
+                f'<ICMS><ICMS00><orig>0</orig><CST>00</CST><modBC>3</modBC><vBC>{total:.2f}</vBC>'
+                f'<pICMS>18.00</pICMS><vICMS>{icms:.2f}</vICMS></ICMS00></ICMS>'
+                f'{ipi}</imposto></det>'
+            )
+
+        arquivo.write('<total><ICMSTot><vNF>0.00</vNF></ICMSTot></total></infNFe></NFe></nfeProc>')
+
+
+def gerar_catalogo(conn, produtos, campos=5, valores_por_campo=8, proporcao_atribuida=0.7, seed=0):
+    """
+    Popula products (já enriquecidos), custom_fields, custom_values e
+    product_custom_field_values. Retorna {campo_id: [valor_id, ...]}.
+    """
+    rnd = random.Random(seed)
+    cursor = conn.cursor()
+
+    linhas = (
+        (f"C{numero:07d}", str(7800000000000 + numero), f"Produto sintético {numero}",
+         rnd.choice(CATEGORIAS), rnd.choice(MARCAS), f"Modelo {rnd.randint(1, 200)}",
+         rnd.choice(CORES), rnd.choice(FAIXAS_ETARIAS), rnd.choice(GENEROS))
+        for numero in range(1, produtos + 1)
+    )
+    cursor.executemany("""
+        INSERT INTO products (codigo, ean, descricao, categoria, marca, modelo, cor, faixa_etaria, genero)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, linhas)
+
+    valores = {}
+    for numero in range(1, campos + 1):
+        cursor.execute("INSERT INTO custom_fields (nome, tipo) VALUES (?, 'manual')", (f"Campo {numero}",))
+        campo_id = cursor.lastrowid
+        valores[campo_id] = []
+        for indice in range(1, valores_por_campo + 1):
+            cursor.execute("INSERT INTO custom_values (campo_id, valor) VALUES (?, ?)",
+                           (campo_id, f"Valor {numero}.{indice}"))
+            valores[campo_id].append(cursor.lastrowid)
+
+    ids = [linha[0] for linha in cursor.execute("SELECT id FROM products")]
+    atribuicoes = (
+        (produto_id, campo_id, rnd.choice(lista))
+        for produto_id in ids
+        for campo_id, lista in valores.items()
+        if rnd.random() < proporcao_atribuida
+    )
+    cursor.executemany("""
+        INSERT OR IGNORE INTO product_custom_field_values (produto_id, campo_id, valor_id)
+        VALUES (?, ?, ?)
+    """, atribuicoes)
+    conn.commit()
+    return valores
@@ -0,0 +1,284 @@
+"""
+Benchmarks de importação, listagem, gravação em massa e geração de nomes
+comerciais, executados com o test client do Flask contra um SQLite
+temporário.
+
+Com --memoria, cada cenário de memória roda num processo próprio e o
+resultado traz o pico de RSS acima da base do processo.
+
+Uso:
+    python benchmarks/run_benchmarks.py --itens 20000 --produtos 50000 --saida atual.json
+    python benchmarks/run_benchmarks.py --comparar anterior.json
+    python benchmarks/run_benchmarks.py --memoria --itens 200000 --produtos 200000
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.geradores import gerar_catalogo, gerar_nfe  # noqa: E402
+import app as aplicacao  # noqa: E402
+
+
+def cronometrar(funcao, repeticoes, preparar=None):
+    """
+    Executa `funcao` `repeticoes` vezes (chamando `preparar` antes de cada
+    uma, fora da medição) e retorna as estatísticas em segundos.
+    """
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar:
+            preparar()
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return {
+        'min': round(min(tempos), 4),
+        'mediana': round(statistics.median(tempos), 4),
+        'max': round(max(tempos), 4),
+        'repeticoes': repeticoes,
+    }
+
+
+def usar_banco(caminho):
+    aplicacao.fechar_conexoes()
+    aplicacao.app.config['DATABASE'] = caminho
+    aplicacao.invalidar_cache_campos()
+    aplicacao.init_db()
+
+
+def verificar(resposta):
+    if resposta.status_code >= 400:
+        raise RuntimeError(f"Resposta inesperada: {resposta.status_code} {resposta.data[:200]!r}")
+    return resposta
+
+
+CENARIOS_MEMORIA = ('importacao_lote', 'exportacao_csv', 'listagem_html', 'salvar_todos')
+
+
+def memoria_processo_mb():
+    """
+    (RSS atual, pico de RSS) do processo em MB. No Linux lê /proc e zera o
+    pico antes da medição, pois ru_maxrss herda o pico do processo pai
+    (fork) e não serve para um filho recém-criado.
+    """
+    try:
+        with open('/proc/self/status') as arquivo:
+            status = dict(linha.split(':', 1) for linha in arquivo)
+        return (round(int(status['VmRSS'].split()[0]) / 1024, 1),
+                round(int(status['VmHWM'].split()[0]) / 1024, 1))
+    except (OSError, KeyError):
+        return aplicacao.pico_memoria_mb(), aplicacao.pico_memoria_mb()
+
+
+def zerar_pico_memoria():
+    try:
+        with open('/proc/self/clear_refs', 'w') as arquivo:
+            arquivo.write('5')
+    except OSError:
+        pass
+
+
+def medir_cenario_memoria(args):
+    """
+    Executado no processo filho: prepara o cenário, mede a base de RSS e
+    então o pico durante a execução. Imprime o resultado em JSON.
+    """
+    pasta = os.path.dirname(args.banco)
+    aplicacao.app.config['UPLOAD_FOLDER'] = pasta
+    cliente = aplicacao.app.test_client()
+
+    if args.cenario_memoria == 'importacao_lote':
+        usar_banco(os.path.join(pasta, f'memoria_{os.getpid()}.db'))
+
+        def executar_cenario():
+            aplicacao.importar_arquivos([args.xml], workers=1)
+    else:
+        usar_banco(args.banco)
+        campo_id, valor_id = aplicacao.get_db().execute(
+            "SELECT campo_id, id FROM custom_values ORDER BY id LIMIT 1").fetchone()
+        payload = {'valores': [
+            {'produto_id': produto_id, 'campo_id': campo_id, 'valor_id': valor_id}
+            for produto_id in range(1, args.salvar + 1)
+        ]}
+
+        def executar_cenario():
+            if args.cenario_memoria == 'exportacao_csv':
+                for _ in aplicacao.gerar_exportacao('csv', {}, {}):
+                    pass
+            elif args.cenario_memoria == 'listagem_html':
+                limite = aplicacao.app.config['PRODUTOS_MAX_PAGE_SIZE']
+                verificar(cliente.get(f'/produtos?limit={limite}')).get_data()
+            else:
+                verificar(cliente.post('/salvar_todos', json=payload))
+
+    zerar_pico_memoria()
+    base, _ = memoria_processo_mb()
+    executar_cenario()
+    _, pico = memoria_processo_mb()
+    print(json.dumps({'base_mb': base, 'pico_mb': pico, 'acrescimo_mb': round(pico - base, 1)}))
+
+
+def medir_memoria(args, xml, banco):
+    """
+    Roda cada cenário de memória num processo novo, para que o pico de um
+    não esconda o do seguinte.
+    """
+    resultados = {}
+    for cenario in CENARIOS_MEMORIA:
+        comando = [sys.executable, os.path.abspath(__file__), '--cenario-memoria', cenario,
+                   '--xml', xml, '--banco', banco, '--salvar', str(args.salvar)]
+        saida = subprocess.run(comando, capture_output=True, text=True, check=True).stdout
+        resultados[cenario] = json.loads(saida.strip().splitlines()[-1])
+    return resultados
+
+
+def executar(args):
+    pasta = tempfile.mkdtemp(prefix='bench_')
+    aplicacao.app.config['UPLOAD_FOLDER'] = pasta
+    cliente = aplicacao.app.test_client()
+    resultados = {}
+
+    # Importação: cada repetição usa um banco novo e um XML já gerado
+    xml = os.path.join(pasta, 'nfe.xml')
+    gerar_nfe(xml, args.itens, proporcao_ipi=args.proporcao_ipi, seed=args.seed)
+    contador = {'banco': 0}
+
+    def novo_banco():
+        contador['banco'] += 1
+        usar_banco(os.path.join(pasta, f"importacao_{contador['banco']}.db"))
+
+    def importar():
+        with open(xml, 'rb') as arquivo:
+            verificar(cliente.post('/importar_lote', data={'files': [(arquivo, 'nfe.xml')]}))
+
+    resultados['importacao'] = cronometrar(importar, args.repeticoes, preparar=novo_banco)
+    resultados['importacao']['itens_por_segundo'] = round(args.itens / resultados['importacao']['mediana'], 1)
+
+    # Demais cenários compartilham um catálogo sintético
+    usar_banco(os.path.join(pasta, 'catalogo.db'))
+    conn = sqlite3.connect(aplicacao.app.config['DATABASE'])
+    valores = gerar_catalogo(conn, args.produtos, campos=args.campos, seed=args.seed)
+    conn.close()
+
+    resultados['listagem_html'] = cronometrar(
+        lambda: verificar(cliente.get('/produtos')).get_data(), args.repeticoes)
+
+    def paginar_api():
+        after = 0
+        for _ in range(args.paginas):
+            dados = verificar(cliente.get(f'/api/produtos?after={after}')).get_json()
+            if dados['next_after'] is None:
+                break
+            after = dados['next_after']
+
+    resultados['listagem_api_paginas'] = cronometrar(paginar_api, args.repeticoes)
+    resultados['listagem_api_paginas']['paginas'] = args.paginas
+
+    campo_id, lista_valores = next(iter(valores.items()))
+    payload = {'valores': [
+        {'produto_id': produto_id, 'campo_id': campo_id, 'valor_id': lista_valores[produto_id % len(lista_valores)]}
+        for produto_id in range(1, min(args.produtos, args.salvar) + 1)
+    ]}
+    resultados['salvar_todos'] = cronometrar(
+        lambda: verificar(cliente.post('/salvar_todos', json=payload)), args.repeticoes)
+    resultados['salvar_todos']['itens'] = len(payload['valores'])
+
+    # O recálculo só grava os nomes que mudam: cada repetição parte de nomes
+    # vazios para medir a geração completa, não uma passada sem alterações
+    def limpar_nomes():
+        with aplicacao.get_db() as conn:
+            conn.execute("UPDATE products SET nome_comercial = NULL")
+
+    resultados['nome_comercial_completo'] = cronometrar(
+        lambda: verificar(cliente.post('/atualizar_nome_comercial', data={'modo': 'completo'})),
+        args.repeticoes, preparar=limpar_nomes)
+
+    aplicacao.fechar_conexoes()
+    memoria = medir_memoria(args, xml, aplicacao.app.config['DATABASE']) if args.memoria else None
+    shutil.rmtree(pasta, ignore_errors=True)
+    return {
+        'gerado_em': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'ambiente': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'plataforma': platform.platform(),
+        },
+        'parametros': vars(args),
+        'pico_memoria_mb': aplicacao.pico_memoria_mb(),
+        'resultados': resultados,
+        'memoria': memoria,
+    }
+
+
+def comparar(atual, anterior):
+    """
+    Imprime a variação da mediana de cada benchmark em relação à execução anterior.
+    """
+    print(f"{'benchmark':<28}{'anterior':>12}{'atual':>12}{'variação':>12}")
+    for nome, dados in atual['resultados'].items():
+        antes = anterior.get('resultados', {}).get(nome)
+        if not antes:
+            print(f"{nome:<28}{'-':>12}{dados['mediana']:>12.4f}{'novo':>12}")
+            continue
+        variacao = (dados['mediana'] - antes['mediana']) / antes['mediana'] * 100 if antes['mediana'] else 0.0
+        print(f"{nome:<28}{antes['mediana']:>12.4f}{dados['mediana']:>12.4f}{variacao:>+11.1f}%")
+
+    if atual.get('memoria') and anterior.get('memoria'):
+        print(f"\n{'memória (MB acima da base)':<28}{'anterior':>12}{'atual':>12}{'variação':>12}")
+        for nome, dados in atual['memoria'].items():
+            antes = anterior['memoria'].get(nome)
+            if not antes:
+                continue
+            variacao = dados['acrescimo_mb'] - antes['acrescimo_mb']
+            print(f"{nome:<28}{antes['acrescimo_mb']:>12.1f}{dados['acrescimo_mb']:>12.1f}{variacao:>+12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--itens', type=int, default=5000, help='Itens da NF-e sintética.')
+    parser.add_argument('--proporcao-ipi', type=float, default=0.5, help='Fração de itens com IPI.')
+    parser.add_argument('--produtos', type=int, default=20000, help='Produtos do catálogo sintético.')
+    parser.add_argument('--campos', type=int, default=5, help='Campos personalizados do catálogo.')
+    parser.add_argument('--paginas', type=int, default=10, help='Páginas lidas na listagem pela API.')
+    parser.add_argument('--salvar', type=int, default=5000, help='Itens enviados a /salvar_todos.')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--saida', help='Grava o resultado JSON neste arquivo.')
+    parser.add_argument('--comparar', help='JSON de uma execução anterior para comparação.')
+    parser.add_argument('--memoria', action='store_true', help='Mede também o pico de RSS por cenário.')
+    # Uso interno: execução de um cenário de memória no processo filho
+    parser.add_argument('--cenario-memoria', choices=CENARIOS_MEMORIA, help=argparse.SUPPRESS)
+    parser.add_argument('--xml', help=argparse.SUPPRESS)
+    parser.add_argument('--banco', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cenario_memoria:
+        medir_cenario_memoria(args)
+        return
+
+    resultado = executar(args)
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(texto)
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            comparar(resultado, json.load(arquivo))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,47 +6,71 @@ function toggleAllCheckboxes(source) {
     });
 }
 
-// Função para salvar todos os dados da tabela
+// Marca as células editadas da grade; só elas são enviadas ao salvar
+document.addEventListener('focusin', evento => {
+    const celula = evento.target.closest?.('td[contenteditable]');
+    if (celula && celula.dataset.original === undefined) {
+        celula.dataset.original = celula.textContent.trim();
+    }
+});
+document.addEventListener('input', evento => {
+    const celula = evento.target.closest?.('td[contenteditable]');
+    if (celula) {
+        celula.classList.toggle('alterado', celula.textContent.trim() !== celula.dataset.original);
+    }
+});
+
+// Atualiza a linha da grade com os dados devolvidos pelo servidor
+function atualizarLinhaProduto(produto) {
+    const linha = document.querySelector(`#tabela-produtos tr[data-produto-id="${produto.id}"]`);
+    if (!linha) {
+        return;
+    }
+    linha.dataset.versao = produto.versao;
+    linha.querySelectorAll('td[data-coluna]').forEach(celula => {
+        celula.textContent = produto[celula.dataset.coluna] ?? '';
+        celula.classList.remove('alterado');
+        delete celula.dataset.original;
+    });
+}
+
+// Função para salvar as células alteradas da tabela
 function salvarDadosTabela() {
     try {
-        const tabela = document.querySelector("table tbody");
-        const linhas = tabela.querySelectorAll("tr");
-        const dados = [];
-
-        linhas.forEach(linha => {
-            const colunas = linha.querySelectorAll("td");
-            const produtoId = colunas[0]?.textContent.trim();
-            const codigo = colunas[1]?.textContent.trim();
-            const nomeComercial = colunas[2]?.querySelector("input")
-                ? colunas[2].querySelector("input").value.trim()
-                : colunas[2]?.textContent.trim();
-
-            if (produtoId && codigo) {
-                dados.push({
-                    produto_id: produtoId,
-                    codigo: codigo,
-                    nome_comercial: nomeComercial
-                });
-            }
+        const celulas = document.querySelectorAll('#tabela-produtos td.alterado');
+        const alteracoes = Array.from(celulas).map(celula => {
+            const linha = celula.closest('tr');
+            return {
+                produto_id: linha.dataset.produtoId,
+                versao: linha.dataset.versao,
+                campo: celula.dataset.coluna,
+                valor: celula.textContent.trim()
+            };
         });
 
-        // Envia os dados para o backend usando fetch
+        if (alteracoes.length === 0) {
+            alert("Nenhuma alteração para salvar.");
+            return;
+        }
+
+        // Envia apenas as alterações para o backend usando fetch
         fetch('/salvar_tabela_produtos', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ produtos: dados }) // Dados em formato JSON
+            body: JSON.stringify({ alteracoes: alteracoes })
         })
         .then(response => response.json())
         .then(data => {
-            console.log(data); // Verifica a resposta do backend
-            if (data.status === "success") {
-                alert(data.message);
-                location.reload(); // Recarrega a página após salvar
-            } else {
+            if (data.status === "error") {
                 alert("Erro ao salvar: " + data.message);
+                return;
             }
+            // Linhas gravadas e rejeitadas voltam com os valores atuais
+            data.produtos.forEach(atualizarLinhaProduto);
+            data.conflitos.forEach(atualizarLinhaProduto);
+            alert(data.message);
         })
         .catch(error => console.error("Erro ao salvar dados:", error));
     } catch (error) {
@@ -54,60 +78,213 @@ function salvarDadosTabela() {
     }
 }
 
-// Função para aplicar o mesmo valor a todos os produtos selecionados
+// Função para aplicar o mesmo valor a todos os produtos selecionados (ou filtrados)
 function aplicarSelecionados(selectElement) {
     try {
         const valorSelecionado = selectElement.value;  // Valor escolhido no campo
         const campoId = selectElement.dataset.campoId; // ID do campo personalizado
+        const textoValor = selectElement.options[selectElement.selectedIndex].text;
+        const alvo = document.querySelector('input[name="alvo-em-massa"]:checked')?.value || 'selecionados';
 
         if (!valorSelecionado) {
             alert("Selecione um valor válido para aplicar.");
             return;
         }
 
-        const checkboxesSelecionados = document.querySelectorAll('.product-checkbox:checked');
-        if (checkboxesSelecionados.length === 0) {
-            alert("Nenhum produto selecionado. Selecione pelo menos um produto.");
-            return;
+        const dados = { campo_id: campoId, valor_id: valorSelecionado };
+        let linhas;
+
+        if (alvo === 'filtrados') {
+            // O servidor aplica ao filtro inteiro, não só às linhas carregadas
+            const filtros = Object.fromEntries(new URLSearchParams(window.location.search));
+            delete filtros.after;
+            delete filtros.limit;
+            dados.filtros = filtros;
+            linhas = Array.from(document.querySelectorAll('#tabela-produtos tbody tr'));
+        } else {
+            const checkboxesSelecionados = document.querySelectorAll('.product-checkbox:checked');
+            if (checkboxesSelecionados.length === 0) {
+                alert("Nenhum produto selecionado. Selecione pelo menos um produto.");
+                selectElement.value = '';
+                return;
+            }
+            dados.produto_ids = Array.from(checkboxesSelecionados).map(checkbox => checkbox.value);
+            linhas = Array.from(checkboxesSelecionados).map(checkbox => checkbox.closest('tr'));
         }
 
-        // Aplica o valor em todos os campos correspondentes
-        checkboxesSelecionados.forEach(checkbox => {
-            const produtoRow = checkbox.closest('tr');
-            const selectCampo = produtoRow.querySelector(`select[data-campo-id="${campoId}"]`);
-            if (selectCampo) {
-                selectCampo.value = valorSelecionado; // Aplica o valor
+        fetch('/atribuir_valor_em_massa', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(dados)
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.status !== "success") {
+                alert("Erro ao aplicar: " + data.message);
+                return;
             }
-        });
 
-        alert("Valores aplicados com sucesso aos produtos selecionados!");
+            // Atualiza as células do campo nas linhas afetadas, sem recarregar
+            const cabecalho = document.querySelector(`#tabela-produtos th[data-campo-id="${campoId}"]`);
+            const indice = Array.from(cabecalho.parentElement.children).indexOf(cabecalho);
+            linhas.forEach(linha => {
+                if (linha.children[indice]) {
+                    linha.children[indice].textContent = textoValor;
+                }
+            });
+            alert(data.message);
+        })
+        .catch(error => console.error("Erro ao aplicar valores:", error))
+        .finally(() => { selectElement.value = ''; });
     } catch (error) {
         console.error("Erro na função aplicarSelecionados:", error);
     }
 }
 
-// Função para atualizar o nome comercial de todos os produtos
-function atualizarNomeComercial() {
-    fetch('/atualizar_nome_comercial', {
-        method: 'POST'
+// Função para atualizar o nome comercial de todos os produtos (em segundo plano)
+function atualizarNomeComercial(evento) {
+    evento.preventDefault();
+    const modo = evento.submitter?.value || 'completo';
+
+    fetch('/jobs', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ tipo: 'nome_comercial', parametros: { modo: modo } })
     })
-    .then(() => {
-        alert("Nomes comerciais atualizados com sucesso!");
-        location.reload(); // Recarrega a página para exibir os dados atualizados
+    .then(response => response.json())
+    .then(data => {
+        if (data.status !== "success") {
+            alert("Erro ao iniciar a atualização: " + data.message);
+            return;
+        }
+        acompanharJob(data.job_id, job => {
+            if (job.status === 'concluido') {
+                alert(`Nomes comerciais atualizados: ${job.resultado.atualizados} produtos.`);
+                location.reload(); // Recarrega a página para exibir os dados atualizados
+            }
+        });
     })
     .catch(error => {
         console.error("Erro ao atualizar nomes comerciais:", error);
         alert("Erro ao atualizar nomes comerciais.");
     });
+    return false;
 }
 
+// Consulta o progresso de um job até ele terminar, exibindo-o em #status-job
+function acompanharJob(jobId, aoTerminar, intervalo = 1000) {
+    const status = document.getElementById('status-job');
+    const cancelar = document.getElementById('cancelar-job');
+    if (cancelar) {
+        cancelar.style.display = '';
+        cancelar.onclick = () => fetch(`/jobs/${jobId}/cancelar`, { method: 'POST' });
+    }
 
+    const consultar = () => {
+        fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(data => {
+                const job = data.job;
+                let texto = `Job ${job.id}: ${job.status}`;
+                if (job.total) {
+                    texto += ` — ${job.processados} de ${job.total} (${job.percentual}%)`;
+                }
+                if (job.eta_segundos !== null) {
+                    texto += `, faltam ~${Math.ceil(job.eta_segundos)}s`;
+                }
+                if (job.erro) {
+                    texto += ` — ${job.erro}`;
+                }
+                if (status) {
+                    status.textContent = texto;
+                }
 
-// Requisição para carregar produtos (exemplo de uso)
-fetch('/produtos')
-    .then(response => response.json())
-    .then(data => {
-        console.log("Dados recebidos:", data);
-        // Lógica para atualizar a tabela na página, se necessário
-    })
-    .catch(error => console.error("Erro ao carregar os produtos:", error));
+                if (job.status === 'pendente' || job.status === 'executando') {
+                    setTimeout(consultar, intervalo);
+                    return;
+                }
+                if (cancelar) {
+                    cancelar.style.display = 'none';
+                }
+                aoTerminar(job);
+            })
+            .catch(error => console.error("Erro ao consultar o job:", error));
+    };
+    consultar();
+}
+
+
+
+// Carrega a próxima página de produtos (keyset pelo id) e adiciona à tabela
+function carregarMaisProdutos() {
+    const tabela = document.getElementById('tabela-produtos');
+    const botao = document.getElementById('carregar-mais');
+    const proximo = botao.dataset.nextAfter;
+    if (!proximo) {
+        return;
+    }
+
+    // Mantém os mesmos filtros da página atual
+    const parametros = new URLSearchParams(window.location.search);
+    parametros.set('after', proximo);
+    botao.disabled = true;
+
+    fetch('/api/produtos?' + parametros.toString())
+        .then(response => response.json())
+        .then(data => {
+            if (data.status !== "success") {
+                alert("Erro ao carregar os produtos: " + data.message);
+                return;
+            }
+
+            const colunas = ['id', 'codigo', 'ean', 'descricao', 'categoria', 'marca', 'modelo',
+                             'cor', 'faixa_etaria', 'genero', 'nome_comercial'];
+            const editaveis = ['descricao', 'categoria', 'marca', 'modelo', 'cor',
+                               'faixa_etaria', 'genero', 'nome_comercial'];
+            const campos = Array.from(tabela.querySelectorAll('th[data-campo-id]'))
+                .map(th => th.dataset.campoId);
+            const corpo = tabela.querySelector('tbody');
+
+            data.produtos.forEach(produto => {
+                const linha = document.createElement('tr');
+                linha.dataset.produtoId = produto.id;
+                linha.dataset.versao = produto.versao;
+                colunas.forEach(coluna => {
+                    const celula = document.createElement('td');
+                    celula.textContent = produto[coluna] ?? '';
+                    if (coluna !== 'id') {
+                        celula.dataset.coluna = coluna;
+                    }
+                    if (editaveis.includes(coluna)) {
+                        celula.contentEditable = 'true';
+                    }
+                    if (coluna === 'id') {
+                        const checkbox = document.createElement('input');
+                        checkbox.type = 'checkbox';
+                        checkbox.className = 'product-checkbox';
+                        checkbox.value = produto.id;
+                        celula.prepend(checkbox, ' ');
+                    }
+                    linha.appendChild(celula);
+                });
+                campos.forEach(campoId => {
+                    const celula = document.createElement('td');
+                    const atribuido = produto.valores[campoId];
+                    celula.textContent = atribuido && atribuido.valor ? atribuido.valor : 'Sem valores';
+                    linha.appendChild(celula);
+                });
+                corpo.appendChild(linha);
+            });
+
+            botao.dataset.nextAfter = data.next_after ?? '';
+            if (data.next_after === null) {
+                botao.style.display = 'none';
+            }
+        })
+        .catch(error => console.error("Erro ao carregar os produtos:", error))
+        .finally(() => { botao.disabled = false; });
+}